@@ -0,0 +1,719 @@
+#!/usr/bin/env python3
+
+'''
+Benchmark imapdedup against a local, in-process stand-in IMAP server.
+
+The stand-in server holds synthetic mailboxes in memory, with a configurable
+number of messages, duplicate ratio, header size and injected latency, and
+speaks enough IMAP4rev1 for imapdedup to run end to end. Each benchmark run
+reports messages/sec, round trips, bytes transferred and peak RSS. imapdedup
+runs in a process of its own, so the peak RSS is just its own, and not the
+server's or that of an earlier mode.
+
+    ./bench.py --messages 20000 --dupes 0.2 --latency 0.02
+    ./bench.py --modes default,checksum --mailboxes 4 --args '--pipeline 4' --json bench_output.txt
+'''
+
+import argparse
+import bisect
+import hashlib
+import io
+import json
+import os
+import random
+import re
+import shlex
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from email.utils import formatdate
+from queue import Queue
+from typing import Dict, List, Optional, Tuple
+
+import imapdedup
+
+
+class FakeMessage:
+    __slots__ = ('uid', 'header', 'body', 'flags', 'internaldate', 'modseq')
+
+    def __init__(self, uid: int, header: bytes, body: bytes, internaldate: float):
+        self.uid = uid
+        self.header = header
+        self.body = body
+        self.flags = set()
+        self.internaldate = internaldate
+        self.modseq = 0
+
+    @property
+    def raw(self) -> bytes:
+        return self.header + self.body
+
+
+class FakeMailbox:
+    def __init__(self, name: str, uidvalidity: int):
+        self.name = name
+        self.uidvalidity = uidvalidity
+        self.uidnext = 1
+        self.messages: List[FakeMessage] = []
+        # For CONDSTORE/QRESYNC: the latest change, and (uid, modseq) of each expunge
+        self.highestmodseq = 1
+        self.expunged: List[Tuple[int, int]] = []
+
+    def append(self, header: bytes, body: bytes, internaldate: float) -> FakeMessage:
+        msg = FakeMessage(self.uidnext, header, body, internaldate)
+        self.uidnext += 1
+        self.messages.append(msg)
+        self.touch(msg)
+        return msg
+
+    def touch(self, msg: FakeMessage):
+        self.highestmodseq += 1
+        msg.modseq = self.highestmodseq
+
+    def expunge(self):
+        kept = []
+        for msg in self.messages:
+            if '\\Deleted' in msg.flags:
+                self.highestmodseq += 1
+                self.expunged.append((msg.uid, self.highestmodseq))
+            else:
+                kept.append(msg)
+        self.messages = kept
+
+
+def make_message(n: int, header_size: int, body_size: int) -> Tuple[bytes, bytes]:
+    """
+    Build a synthetic message whose header block is roughly header_size bytes,
+    padded out with Received/DKIM-style trace headers like real mail.
+    """
+    date = formatdate(1_600_000_000 + n * 61)
+    lines = [
+        f'From: Sender {n % 97} <sender{n % 97}@example.com>',
+        f'To: Recipient <user@example.org>',
+        f'Subject: Synthetic message number {n}',
+        f'Date: {date}',
+        f'Message-ID: <{n}.{n * 7919 % 100003}@bench.example.com>',
+    ]
+    hop = 0
+    while sum(len(line) + 2 for line in lines) < header_size:
+        lines.insert(0, f'Received: from relay{hop}.example.net (relay{hop}.example.net [10.0.{hop % 256}.{n % 256}])\r\n'
+                        f'\tby mx{hop}.example.org with ESMTPS id {n:08x}{hop:04x}; {date}')
+        hop += 1
+    header = ('\r\n'.join(lines) + '\r\n\r\n').encode()
+    body = (f'Body of message {n}.\r\n' * max(1, body_size // 24)).encode()
+    return header, body
+
+
+def build_mailboxes(
+    names: List[str], messages: int, dupes: float, header_size: int, body_size: int, seed: int = 1
+) -> Dict[str, FakeMailbox]:
+    """
+    Spread `messages` synthetic messages across the named mailboxes. A
+    `dupes` fraction of them are copies of a message generated earlier, so
+    duplicates occur both within and across mailboxes.
+    """
+    rng = random.Random(seed)
+    boxes = {name: FakeMailbox(name, 1000 + i) for i, name in enumerate(names)}
+    originals: List[Tuple[bytes, bytes]] = []
+    for n in range(messages):
+        box = boxes[names[n * len(names) // messages]]
+        if originals and rng.random() < dupes:
+            header, body = rng.choice(originals)
+        else:
+            header, body = make_message(n, header_size, body_size)
+            originals.append((header, body))
+        box.append(header, body, 1_600_000_000 + n)
+    return boxes
+
+
+def tokenize(line: bytes) -> list:
+    """
+    Split an IMAP command line into atoms, quoted strings and nested
+    parenthesised lists. Square-bracketed sections stay part of their atom,
+    so BODY.PEEK[HEADER.FIELDS (FROM TO)]<0.100> is a single token.
+    """
+    stack: list = [[]]
+    i = 0
+    while i < len(line):
+        c = line[i:i + 1]
+        if c == b' ':
+            i += 1
+        elif c == b'(':
+            stack.append([])
+            i += 1
+        elif c == b')':
+            inner = stack.pop()
+            stack[-1].append(inner)
+            i += 1
+        elif c == b'"':
+            j = i + 1
+            out = b''
+            while line[j:j + 1] != b'"':
+                if line[j:j + 1] == b'\\':
+                    j += 1
+                out += line[j:j + 1]
+                j += 1
+            stack[-1].append(out)
+            i = j + 1
+        else:
+            j = i
+            depth = 0
+            while j < len(line):
+                ch = line[j:j + 1]
+                if ch == b'[':
+                    depth += 1
+                elif ch == b']':
+                    depth -= 1
+                elif depth == 0 and ch in (b' ', b')', b'('):
+                    break
+                j += 1
+            stack[-1].append(line[i:j])
+            i = j
+    return stack[0]
+
+
+def parse_uid_set(spec: bytes, maximum: int) -> List[Tuple[int, int]]:
+    ranges = []
+    for part in spec.split(b','):
+        lo, _, hi = part.partition(b':')
+        lo_n = maximum if lo == b'*' else int(lo)
+        hi_n = lo_n if not hi else (maximum if hi == b'*' else int(hi))
+        ranges.append((min(lo_n, hi_n), max(lo_n, hi_n)))
+    return ranges
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.commands = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.by_command: Dict[str, int] = {}
+
+    def as_dict(self) -> dict:
+        return {
+            'commands': self.commands,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'by_command': dict(sorted(self.by_command.items())),
+        }
+
+
+class FakeImapHandler(socketserver.StreamRequestHandler):
+    """
+    One client connection. Commands are read as they arrive and answered in
+    order, each no earlier than `latency` seconds after it was received, so
+    pipelined commands overlap their round trips the way they would on a
+    real high-latency link.
+    """
+
+    def setup(self):
+        super().setup()
+        self.selected: Optional[FakeMailbox] = None
+        self.tag = ''
+        self.readonly = False
+        # Set once the client turns on COMPRESS=DEFLATE
+        self.compressor = None
+        # Extensions the client has turned on with ENABLE
+        self.enabled: set = set()
+
+    @property
+    def bench(self) -> 'FakeImapServer':
+        return self.server  # type: ignore
+
+    def send(self, data: bytes):
+        if self.compressor is not None:
+            data = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.wfile.write(data)
+        with self.bench.stats.lock:
+            self.bench.stats.bytes_out += len(data)
+
+    def line(self, text: str):
+        self.send(text.encode() + b'\r\n')
+
+    def read_commands(self, queue: 'Queue'):
+        while True:
+            raw = self.rfile.readline()
+            queue.put((time.monotonic(), raw))
+            if not raw:
+                return
+            if raw.split()[1:2] == [b'COMPRESS'] and 'COMPRESS=DEFLATE' in self.bench.capabilities:
+                # The client compresses from the command after this one
+                self.rfile = io.BufferedReader(imapdedup.DeflateReader(self.rfile))
+
+    def handle(self):
+        self.line('* OK [CAPABILITY %s] imapdedup bench server ready' % ' '.join(self.bench.capabilities))
+        queue: Queue = Queue()
+        threading.Thread(target=self.read_commands, args=(queue,), daemon=True).start()
+        while True:
+            arrived, raw = queue.get()
+            if not raw:
+                return
+            with self.bench.stats.lock:
+                self.bench.stats.bytes_in += len(raw)
+            line = raw.rstrip(b'\r\n')
+            tag, _, rest = line.partition(b' ')
+            tokens = tokenize(rest)
+            if not tokens:
+                continue
+            name = tokens[0].upper().decode()
+            self.tag = tag.decode()
+            with self.bench.stats.lock:
+                self.bench.stats.commands += 1
+                self.bench.stats.by_command[name] = self.bench.stats.by_command.get(name, 0) + 1
+            delay = arrived + self.bench.latency - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                done = self.dispatch(name, tokens[1:])
+            except Exception as e:  # report rather than drop the connection
+                self.line(f'{tag.decode()} BAD {type(e).__name__}: {e}')
+                self.wfile.flush()
+                continue
+            self.line(f'{tag.decode()} {done}')
+            self.wfile.flush()
+            if name == 'COMPRESS':
+                self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+            if name == 'LOGOUT':
+                return
+
+    def dispatch(self, name: str, args: list) -> str:
+        if name == 'UID':
+            sub = args[0].upper().decode()
+            return getattr(self, 'cmd_' + sub.lower())(args[1:], uid=True)
+        return getattr(self, 'cmd_' + name.lower())(args)
+
+    def cmd_capability(self, args):
+        self.line('* CAPABILITY ' + ' '.join(self.bench.capabilities))
+        return 'OK CAPABILITY completed'
+
+    def cmd_noop(self, args):
+        return 'OK NOOP completed'
+
+    def cmd_enable(self, args):
+        enabled = [a.decode() for a in args if a.decode() in self.bench.capabilities]
+        self.enabled.update(enabled)
+        self.line('* ENABLED ' + ' '.join(enabled))
+        return 'OK ENABLE completed'
+
+    def cmd_compress(self, args):
+        if 'COMPRESS=DEFLATE' not in self.bench.capabilities or args[0].upper() != b'DEFLATE':
+            return 'NO compression not supported'
+        return 'OK DEFLATE active'
+
+    def cmd_login(self, args):
+        return 'OK LOGIN completed'
+
+    def cmd_logout(self, args):
+        self.line('* BYE logging out')
+        return 'OK LOGOUT completed'
+
+    def cmd_list(self, args):
+        ref = args[0].decode()
+        pattern = args[1].decode()
+        if pattern == '':
+            self.line('* LIST (\\Noselect) "/" ""')
+            return 'OK LIST completed'
+        regex = re.compile('^' + re.escape(ref + pattern).replace(r'\*', '.*').replace('%', '[^/]*') + '$')
+        for name in self.bench.mailboxes:
+            if regex.match(name):
+                self.line(f'* LIST (\\HasNoChildren) "/" "{name}"')
+        return 'OK LIST completed'
+
+    def cmd_select(self, args, readonly=False):
+        name = args[0].decode()
+        params = args[1] if len(args) > 1 else []
+        if params and params[0].upper() == b'QRESYNC' and 'QRESYNC' not in self.enabled:
+            return 'BAD QRESYNC must be enabled first'  # RFC 7162 section 3.2.5
+        box = self.bench.mailboxes.get(name)
+        if box is None:
+            self.selected = None
+            return 'NO no such mailbox'
+        self.selected = box
+        self.readonly = readonly
+        self.line(f'* {len(box.messages)} EXISTS')
+        self.line('* 0 RECENT')
+        self.line('* FLAGS (\\Answered \\Flagged \\Deleted \\Seen \\Draft)')
+        self.line(f'* OK [UIDVALIDITY {box.uidvalidity}] UIDs valid')
+        self.line(f'* OK [UIDNEXT {box.uidnext}] Predicted next UID')
+        if 'CONDSTORE' in self.bench.capabilities or 'QRESYNC' in self.bench.capabilities:
+            self.line(f'* OK [HIGHESTMODSEQ {box.highestmodseq}] Highest')
+        if params and params[0].upper() == b'QRESYNC' and int(params[1][0]) == box.uidvalidity:
+            # RFC 7162: report what was expunged and changed since the given modseq
+            since = int(params[1][1])
+            vanished = [uid for uid, modseq in box.expunged if modseq > since]
+            if vanished:
+                self.line('* VANISHED (EARLIER) ' + imapdedup.format_uid_set(vanished))
+            for seq, msg in enumerate(box.messages, 1):
+                if msg.modseq > since:
+                    self.send(b'* %d FETCH (UID %d %s MODSEQ (%d))\r\n' % (
+                        seq, msg.uid, self.fetch_item(msg, b'FLAGS'), msg.modseq))
+        mode = 'READ-ONLY' if readonly else 'READ-WRITE'
+        return f'OK [{mode}] {"EXAMINE" if readonly else "SELECT"} completed'
+
+    def cmd_examine(self, args):
+        return self.cmd_select(args, readonly=True)
+
+    def cmd_close(self, args):
+        if self.selected is not None and not self.readonly:
+            self.selected.expunge()
+        self.selected = None
+        return 'OK CLOSE completed'
+
+    def match_search(self, box: FakeMailbox, criteria: list) -> List[Tuple[int, FakeMessage]]:
+        result = []
+        for seq, msg in enumerate(box.messages, 1):
+            ok = True
+            i = 0
+            while i < len(criteria):
+                key = criteria[i].upper()
+                if key == b'ALL':
+                    pass
+                elif key == b'DELETED':
+                    ok = ok and '\\Deleted' in msg.flags
+                elif key == b'UNDELETED':
+                    ok = ok and '\\Deleted' not in msg.flags
+                elif key == b'KEYWORD':
+                    i += 1
+                    ok = ok and criteria[i].decode() in msg.flags
+                elif key == b'SENTBEFORE':
+                    i += 1  # synthetic mail is all in the past
+                else:
+                    raise ValueError(f'unsupported search key {key!r}')
+                i += 1
+            if ok:
+                result.append((seq, msg))
+        return result
+
+    def cmd_search(self, args, uid=False):
+        box = self.selected
+        if args and args[0].upper() == b'RETURN':
+            return self.cmd_esearch(args[1], args[2:], uid)
+        found = self.match_search(box, args)
+        nums = [m.uid if uid else seq for seq, m in found]
+        self.line('* SEARCH' + ''.join(f' {n}' for n in nums))
+        return 'OK SEARCH completed'
+
+    def cmd_esearch(self, returns: list, criteria: list, uid: bool):
+        """ SEARCH RETURN (...) as in RFC 4731, for servers advertising ESEARCH. """
+        if 'ESEARCH' not in self.bench.capabilities:
+            raise ValueError('ESEARCH not enabled')
+        found = self.match_search(self.selected, criteria)
+        nums = [m.uid if uid else seq for seq, m in found]
+        parts = [f'* ESEARCH (TAG "{self.tag}")'] + (['UID'] if uid else [])
+        for option in (r.upper() for r in returns or [b'ALL']):
+            if option == b'COUNT':
+                parts.append(f'COUNT {len(nums)}')
+            elif option == b'MIN' and nums:
+                parts.append(f'MIN {min(nums)}')
+            elif option == b'MAX' and nums:
+                parts.append(f'MAX {max(nums)}')
+            elif option == b'ALL' and nums:
+                parts.append('ALL ' + imapdedup.format_uid_set(nums))
+        self.line(' '.join(parts))
+        return 'OK SEARCH completed'
+
+    def select_messages(self, spec: bytes, uid: bool) -> List[Tuple[int, FakeMessage]]:
+        """
+        The (sequence number, message) pairs in a sequence or UID set. UIDs
+        only ever increase along the mailbox, so each range is a bisect.
+        """
+        box = self.selected
+        messages = box.messages
+        if uid:
+            uids = [m.uid for m in messages]
+            ranges = parse_uid_set(spec, box.uidnext - 1)
+            spans = [(bisect.bisect_left(uids, lo), bisect.bisect_right(uids, hi)) for lo, hi in ranges]
+        else:
+            spans = [(lo - 1, hi) for lo, hi in parse_uid_set(spec, len(messages))]
+        # Ranges may overlap or come in any order, but each message is reported once
+        indexes = sorted({i for start, end in spans for i in range(max(start, 0), end)})
+        return [(i + 1, messages[i]) for i in indexes]
+
+    def fetch_item(self, msg: FakeMessage, item: bytes) -> bytes:
+        upper = item.upper()
+        if upper == b'UID':
+            return b'UID %d' % msg.uid
+        if upper == b'FLAGS':
+            return b'FLAGS (' + ' '.join(sorted(msg.flags)).encode() + b')'
+        if upper == b'EMAILID':
+            return b'EMAILID (M' + hashlib.sha1(msg.raw).hexdigest()[:16].encode() + b')'
+        if upper == b'X-GM-MSGID':
+            return b'X-GM-MSGID %d' % int(hashlib.sha1(msg.raw).hexdigest()[:15], 16)
+        if upper == b'MODSEQ':
+            return b'MODSEQ (%d)' % msg.modseq
+        if upper == b'RFC822.SIZE':
+            return b'RFC822.SIZE %d' % len(msg.raw)
+        if upper == b'INTERNALDATE':
+            stamp = time.strftime('%d-%b-%Y %H:%M:%S +0000', time.gmtime(msg.internaldate))
+            return b'INTERNALDATE "' + stamp.encode() + b'"'
+        if upper in (b'RFC822.HEADER', b'BODY.PEEK[HEADER]', b'BODY[HEADER]'):
+            label = b'RFC822.HEADER' if upper == b'RFC822.HEADER' else b'BODY[HEADER]'
+            return self.literal(label, msg.header)
+        if upper in (b'RFC822', b'BODY.PEEK[]', b'BODY[]'):
+            return self.literal(b'RFC822' if upper == b'RFC822' else b'BODY[]', msg.raw)
+        m = re.match(rb'BODY(?:\.PEEK)?\[HEADER\.FIELDS \((.*)\)\]$', item, re.I)
+        if m:
+            wanted = {f.lower() for f in m.group(1).split()}
+            return self.literal(b'BODY[HEADER.FIELDS (' + m.group(1) + b')]', filter_header(msg.header, wanted))
+        m = re.match(rb'BODY(?:\.PEEK)?\[TEXT\](?:<(\d+)\.(\d+)>)?$', item, re.I)
+        if m:
+            start = int(m.group(1) or 0)
+            data = msg.body[start:start + int(m.group(2))] if m.group(2) else msg.body
+            origin = b'<%d>' % start if m.group(1) else b''
+            return self.literal(b'BODY[TEXT]' + origin, data)
+        raise ValueError(f'unsupported fetch item {item!r}')
+
+    def literal(self, label: bytes, data: bytes) -> bytes:
+        return label + b' {%d}\r\n' % len(data) + data
+
+    def cmd_fetch(self, args, uid=False):
+        spec, items = args[0], args[1]
+        if not isinstance(items, list):
+            items = [items]
+        if uid and not any(i.upper() == b'UID' for i in items):
+            items = [b'UID'] + items
+        # The CHANGEDSINCE modifier from RFC 7162
+        since = int(args[2][1]) if len(args) > 2 and args[2][0].upper() == b'CHANGEDSINCE' else None
+        if since is not None:
+            items = items + [b'MODSEQ']
+        for seq, msg in self.select_messages(spec, uid):
+            if since is not None and msg.modseq <= since:
+                continue
+            parts = [self.fetch_item(msg, item) for item in items]
+            self.send(b'* %d FETCH (' % seq + b' '.join(parts) + b')\r\n')
+        return 'OK FETCH completed'
+
+    def cmd_store(self, args, uid=False):
+        spec, mode, flags = args[0], args[1].upper(), args[2]
+        if self.readonly:
+            return 'NO mailbox is read-only'
+        if not isinstance(flags, list):
+            flags = [flags]
+        names = {f.decode() for f in flags}
+        for seq, msg in self.select_messages(spec, uid):
+            if mode.startswith(b'+'):
+                msg.flags |= names
+            elif mode.startswith(b'-'):
+                msg.flags -= names
+            else:
+                msg.flags = set(names)
+            self.selected.touch(msg)
+            if b'.SILENT' not in mode:
+                self.send(b'* %d FETCH (' % seq + self.fetch_item(msg, b'FLAGS') + b')\r\n')
+        return 'OK STORE completed'
+
+    def cmd_copy(self, args, uid=False):
+        spec, target = args[0], args[1].decode()
+        dest = self.bench.mailboxes.get(target)
+        if dest is None:
+            return 'NO [TRYCREATE] no such mailbox'
+        for seq, msg in self.select_messages(spec, uid):
+            dest.append(msg.header, msg.body, msg.internaldate)
+        return 'OK COPY completed'
+
+
+def filter_header(header: bytes, wanted: set) -> bytes:
+    """
+    Return just the named fields of a header block, as HEADER.FIELDS would.
+    """
+    out = []
+    keep = False
+    for line in header.split(b'\r\n'):
+        if not line:
+            continue
+        if line[:1] in (b' ', b'\t'):
+            if keep:
+                out.append(line)
+            continue
+        keep = line.split(b':', 1)[0].strip().lower() in wanted
+        if keep:
+            out.append(line)
+    return b'\r\n'.join(out) + b'\r\n\r\n'
+
+
+class FakeImapServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, mailboxes: Dict[str, FakeMailbox], latency: float = 0.0,
+                 capabilities: Optional[List[str]] = None):
+        super().__init__(('127.0.0.1', 0), FakeImapHandler)
+        self.mailboxes = mailboxes
+        self.latency = latency
+        self.capabilities = capabilities or ['IMAP4rev1', 'AUTH=PLAIN', 'UIDPLUS']
+        self.stats = Stats()
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
+
+
+MODES = {
+    'default': [],
+    'checksum': ['-c'],
+    'checksum-id': ['-c', '-m'],
+    'delete-ids': [],  # the --delete-ids file is added by run_mode()
+    'recursive': ['-r'],
+    'same-size': ['--same-size'],
+    'content': ['--content', '4096'],
+}
+
+
+def mailbox_names(count: int) -> List[str]:
+    """ INBOX and its children, so -r finds the same mailboxes as the other modes. """
+    return ['INBOX'] + [f'INBOX/Folder{i}' for i in range(1, count)]
+
+
+# Runs imapdedup in a process of its own, then writes the seconds its run
+# took and its peak RSS in KB to the file named first. ru_maxrss would
+# include whatever the benchmark process had when it was forked, so on
+# Linux the new process's own high-water mark is read from /proc instead.
+RUNNER = '''
+import json, resource, sys, time
+import imapdedup
+started = time.perf_counter()
+imapdedup.process(*imapdedup.get_arguments(sys.argv[2:]))
+seconds = time.perf_counter() - started
+try:
+    with open("/proc/self/status") as f:
+        peak = next(int(line.split()[1]) for line in f if line.startswith("VmHWM:"))
+except (OSError, StopIteration):
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    peak = peak // 1024 if sys.platform == "darwin" else peak
+with open(sys.argv[1], "w") as f:
+    json.dump({"seconds": seconds, "peak_rss_kb": peak}, f)
+'''
+
+
+def run_imapdedup(server: FakeImapServer, args: List[str], mboxes: List[str], workdir: str) -> Tuple[float, int]:
+    """
+    Run imapdedup in its own process against the stand-in server, discarding
+    its output unless it fails. Returns the seconds its run took, not
+    counting starting Python, and its peak RSS in KB, which is then just
+    its own, and not the server's or that of an earlier mode.
+    """
+    result_path = os.path.join(workdir, 'result.json')
+    argv = ['-s', '127.0.0.1', '-p', str(server.port), '-u', 'bench', '-w', 'bench'] + args + mboxes
+    process = subprocess.run(
+        [sys.executable, '-c', RUNNER, result_path] + argv,
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+        cwd=os.path.dirname(os.path.abspath(imapdedup.__file__)),
+    )
+    if process.returncode != 0:
+        sys.stderr.write(process.stdout.decode(errors='replace'))
+        raise subprocess.CalledProcessError(process.returncode, argv)
+    with open(result_path) as f:
+        result = json.load(f)
+    return result['seconds'], result['peak_rss_kb']
+
+
+def run_mode(mode: str, settings: argparse.Namespace, workdir: str) -> dict:
+    """
+    Benchmark one mode against freshly built mailboxes and return its
+    results. Only the imapdedup run itself is timed and counted.
+    """
+    names = mailbox_names(settings.mailboxes)
+    boxes = build_mailboxes(names, settings.messages, settings.dupes, settings.header_size,
+                            settings.body_size, settings.seed)
+    args = MODES[mode] + shlex.split(settings.args)
+    if settings.dry_run:
+        args.append('-n')
+    mboxes = names[:1] if mode == 'recursive' else names
+
+    with FakeImapServer(boxes, settings.latency, settings.capabilities) as server:
+        if mode == 'delete-ids':
+            # Save the IDs of the first mailbox, then delete them everywhere
+            ids_path = os.path.join(workdir, 'delete-ids.txt')
+            run_imapdedup(server, ['-n', '-i', ids_path], names[:1], workdir)
+            args += ['--delete-ids', ids_path]
+        server.stats.reset()
+        elapsed, peak_rss = run_imapdedup(server, args, mboxes, workdir)
+        stats = server.stats.as_dict()
+
+    deleted = sum(1 for box in boxes.values() for msg in box.messages if '\\Deleted' in msg.flags)
+    return {
+        'mode': mode,
+        'args': args,
+        'messages': settings.messages,
+        'mailboxes': len(names),
+        'deleted': deleted,
+        'seconds': round(elapsed, 4),
+        'messages_per_sec': round(settings.messages / elapsed, 1) if elapsed else None,
+        'round_trips': stats['commands'],
+        'bytes_sent': stats['bytes_in'],
+        'bytes_received': stats['bytes_out'],
+        'commands': stats['by_command'],
+        'peak_rss_kb': peak_rss,
+    }
+
+
+def get_arguments(args: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Benchmark imapdedup against a local stand-in IMAP server.')
+    parser.add_argument('--modes', default=','.join(MODES),
+                        help='Comma-separated modes to run, from: %s (default: all)' % ', '.join(MODES))
+    parser.add_argument('--messages', type=int, default=5000, help='Total messages across all mailboxes (default: 5000)')
+    parser.add_argument('--mailboxes', type=int, default=2, help='Number of mailboxes (default: 2)')
+    parser.add_argument('--dupes', type=float, default=0.2, help='Fraction of messages that are duplicates (default: 0.2)')
+    parser.add_argument('--header-size', type=int, default=1500, help='Approximate header bytes per message (default: 1500)')
+    parser.add_argument('--body-size', type=int, default=2000, help='Approximate body bytes per message (default: 2000)')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds of latency added to each command (default: 0)')
+    parser.add_argument('--capability', dest='capabilities', action='append',
+                        help='Advertise this capability (repeatable; replaces the defaults)')
+    parser.add_argument('--args', default='', help='Extra imapdedup arguments for every run, e.g. "--pipeline 4"')
+    parser.add_argument('-n', '--dry-run', dest='dry_run', action='store_true', help='Pass -n so nothing is marked deleted')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed for the synthetic mailboxes (default: 1)')
+    parser.add_argument('--json', dest='json_path', help='Also write the results as JSON to this file')
+    settings = parser.parse_args(args)
+
+    modes = [m.strip() for m in settings.modes.split(',') if m.strip()]
+    unknown = [m for m in modes if m not in MODES]
+    if unknown:
+        parser.error('unknown mode(s): %s' % ', '.join(unknown))
+    settings.modes = modes
+    if settings.messages < 1 or settings.mailboxes < 1 or settings.mailboxes > settings.messages:
+        parser.error('--messages and --mailboxes must be positive, with at least one message per mailbox')
+    if not 0 <= settings.dupes < 1:
+        parser.error('--dupes must be at least 0 and less than 1')
+    return settings
+
+
+def main():
+    settings = get_arguments()
+    results = []
+    print(f'{"mode":<12} {"secs":>8} {"msgs/sec":>10} {"trips":>7} {"KB out":>9} {"KB in":>9} {"deleted":>8} {"RSS MB":>7}')
+    with tempfile.TemporaryDirectory() as workdir:
+        for mode in settings.modes:
+            result = run_mode(mode, settings, workdir)
+            results.append(result)
+            print(f'{mode:<12} {result["seconds"]:>8.2f} {result["messages_per_sec"] or 0:>10.0f} '
+                  f'{result["round_trips"]:>7} {result["bytes_sent"] / 1024:>9.0f} '
+                  f'{result["bytes_received"] / 1024:>9.0f} {result["deleted"]:>8} '
+                  f'{result["peak_rss_kb"] / 1024:>7.0f}')
+
+    if settings.json_path:
+        with open(settings.json_path, 'w') as f:
+            json.dump({'settings': {k: v for k, v in vars(settings).items() if k != 'json_path'},
+                       'results': results}, f, indent=2)
+        print(f'Wrote {settings.json_path}')
+
+
+if __name__ == '__main__':
+    main()
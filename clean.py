@@ -20,20 +20,39 @@ and target server. Action happens in multiple passes:
 
 4. Run a fourth time to mark all messages seen in the first folders
    for deletion in the target folder. (Un-comment the --dry-run at
-   line ~89 in this file to not delete, and just list what would happen.)
+   line ~117 in this file to not delete, and just list what would happen.)
+   The IDs found in both places are saved to blah/matched-ids, and those
+   only on the target to blah/unmatched-ids.txt.
+
+Several config files can be given at once, e.g. './clean.py *.json', in which
+case each one is taken through its next step, several at a time (see --jobs
+and --per-server), with a summary at the end.
 
 If using a Google Mail account, need to first set an app password:
 https://myaccount.google.com/u/2/apppasswords
 (the /u/2 depends on which Google account is in the browser...)
 '''
 
+import argparse
 import json
 import os
 import sys
+from functools import partial
 
 import imapdedup
 
 
+def id_path(work_path, name):
+    '''
+    IDs are saved as indexed SQLite databases, but carry on with the
+    text files from an older version if they're already there.
+    '''
+    text_path = os.path.join(work_path, name + '.txt')
+    if os.path.exists(text_path):
+        return text_path
+    return os.path.join(work_path, name + '.sqlite')
+
+
 def handle(config_path):
     if not os.path.exists(config_path):
         print(f'{config_path} does not exist')
@@ -49,16 +68,16 @@ def handle(config_path):
         target_options = parsed['target']
 
     list_path = os.path.join(work_path, 'mailboxes.json')
-    source_id_path = os.path.join(work_path, 'source-ids.txt')
-    target_id_path = os.path.join(work_path, 'target-ids.txt')
+    source_id_path = id_path(work_path, 'source-ids')
+    target_id_path = id_path(work_path, 'target-ids')
 
     if not os.path.exists(list_path):
         print(f'Saving list of mailboxes to {list_path}')
         print('Remove any entries from that file, and run again to create a list of IDs')
-        options = [
-            "--save-list", list_path
-        ]
-        imapdedup.process(*imapdedup.get_arguments(source_options + options))
+        with imapdedup.Deduper(source_options) as source:
+            mailbox_list = source.list_mailboxes()
+        with open(list_path, 'wt') as f:
+            json.dump(mailbox_list, f, indent=2, separators=(',', ': '), sort_keys=True)
 
     elif not os.path.exists(source_id_path):
         print(f'Writing a list of all message IDs from the source to {source_id_path}')
@@ -70,7 +89,8 @@ def handle(config_path):
         with open(list_path, 'r') as f:
             mboxes = json.load(f)
 
-        imapdedup.process(*imapdedup.get_arguments(source_options + options + mboxes))
+        with imapdedup.Deduper(source_options) as source:
+            return source.run(options + mboxes)
 
     elif not os.path.exists(target_id_path):
         print(f'Writing a list of all recovered message IDs on the target at {source_id_path}')
@@ -81,39 +101,104 @@ def handle(config_path):
         ]
         mboxes = [ 'recovered' ]
 
-        imapdedup.process(*imapdedup.get_arguments(target_options + options + mboxes))
+        with imapdedup.Deduper(target_options) as target:
+            return target.run(options + mboxes)
 
     else:
+        # Only the recovered messages that are also on the source need deleting
+        extension = '.sqlite' if imapdedup.is_id_store(target_id_path) else '.txt'
+        matched_path = os.path.join(work_path, 'matched-ids' + extension)
+        unmatched_path = os.path.join(work_path, 'unmatched-ids.txt')
+        print('Comparing the message IDs on the source and target...')
+        matched_count, unmatched_count = compare_ids(target_id_path, source_id_path, matched_path, unmatched_path)
+        print(f'{matched_count:,} recovered messages are also on the source')
+
         options = [
-            "--delete-ids", source_id_path,
             # "--dry-run"  # don't mark any found items for deletion
         ]
         mboxes = [ 'recovered' ]
 
-        imapdedup.process(*imapdedup.get_arguments(target_options + options + mboxes))
-
-        #
-
-        print('List of message IDs not found in both locations:')
-        gmail = set()
-        with open(source_id_path) as f:
-            for line in f:
-                gmail.add(line.strip())
-
-        recovered = set()
-        with open(target_id_path) as f:
-            for line in f:
-                recovered.add(line.strip())
-        recovered_count = len(recovered)
-
-        remaining = recovered - gmail
-        # for item in remaining:
-        #     print(item)
-        print(f'Found {len(remaining):,} unmwatched out of {recovered_count:,}')
+        # Delete the matched messages, along with any duplicates among the rest
+        matched = imapdedup.load_ids(matched_path)
+        try:
+            with imapdedup.Deduper(target_options + options) as target:
+                scans = target.scan(mboxes)
+                plan = target.plan(scans, delete_ids=matched)
+                target.apply(plan)
+        finally:
+            if isinstance(matched, imapdedup.IdStore):
+                matched.close()
+        summary = {
+            'mailboxes': len(scans),
+            'messages': sum(len(scan.messages) for scan in scans),
+            'duplicates': sum(len(uids) for uids in plan.values()),
+        }
+
+        print(f'List of message IDs not found in both locations is in {unmatched_path}')
+        print(f'Found {unmatched_count:,} unmwatched out of {matched_count + unmatched_count:,}')
+        return summary
+
+
+def compare_ids(target_id_path, source_id_path, matched_path, unmatched_path):
+    '''
+    Split the IDs on the target into those that are also on the source,
+    saved to matched_path for --delete-ids, and those that aren't, listed in
+    unmatched_path. Both are written as we go, and neither list of IDs has
+    to fit in memory. Returns the number of each.
+    '''
+    matched = imapdedup.open_saved_ids(matched_path)
+    matched_count = unmatched_count = 0
+    try:
+        with open(unmatched_path, 'wt') as unmatched:
+            for msg_id, found in imapdedup.match_saved_ids(target_id_path, source_id_path):
+                if found:
+                    matched.add(msg_id)
+                    matched_count += 1
+                else:
+                    print(msg_id, file=unmatched)
+                    unmatched_count += 1
+    finally:
+        matched.close()
+    return matched_count, unmatched_count
+
+
+def config_logins(config_path):
+    '''
+    The login options of a config file's source and target accounts, or
+    nothing if it can't be read (which handle() will report).
+    '''
+    try:
+        with open(config_path) as f:
+            parsed = json.load(f)
+        return [parsed['source'], parsed['target']]
+    except (OSError, ValueError, KeyError):
+        return []
+
+
+def handle_all(config_paths, jobs=4, per_server=2):
+    '''
+    Take each config file through its next step, several at once.
+    '''
+    accounts = []
+    for path in config_paths:
+        logins = config_logins(path)
+        servers = [imapdedup.account_server(args) for args in logins]
+        accounts.append(imapdedup.Account(path, servers, partial(handle, path), logins))
+    results = imapdedup.run_accounts(accounts, jobs, per_server)
+    imapdedup.print_account_summary(results)
 
 
 if __name__ == "__main__":
-    if len(sys.argv) == 2:
-        handle(sys.argv[1])
+    parser = argparse.ArgumentParser(description='Purge messages recovered by Apple Mail that are still on the source.')
+    parser.add_argument('configs', nargs='+', metavar='config', help='JSON file with source and target login options')
+    parser.add_argument('-j', '--jobs', type=int, default=4,
+                        help='Number of config files to work on at once (default 4)')
+    parser.add_argument('--per-server', type=int, default=2,
+                        help='Most config files to work on at once on the same server (default 2)')
+    args = parser.parse_args()
+    if args.jobs < 1 or args.per_server < 1:
+        parser.error('--jobs and --per-server must be at least 1')
+    if len(args.configs) == 1:
+        handle(args.configs[0])
     else:
-        print(f'Usage: {sys.argv[0]} <config json name>')
+        handle_all(args.configs, args.jobs, args.per_server)
@@ -28,31 +28,69 @@
 #   USA.
 #
 
+import cProfile
+import contextvars
 import getpass
+import gzip
 import hashlib
+import heapq
 import imaplib
+import io
 import json
+import logging
+import mmap
 import os
 import argparse
 import re
 import socket
+import sqlite3
 import sys
-from typing import List, Dict, Tuple, Optional, Type, Any
+import tempfile
+import threading
+import time
+import zlib
+from array import array
+from contextlib import nullcontext
+from datetime import datetime, timezone
+from collections import deque
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from functools import lru_cache, partial
+from typing import List, Dict, Tuple, Optional, Type, Any, Iterable, Iterator, Deque, NamedTuple, Union, Callable, TextIO
 
 from email.parser import BytesParser
 from email.message import Message
 from email.errors import HeaderParseError
 from email.header import decode_header
+from email.policy import compat32
 
 # Increase the max line length that imaplib expects to get back from the server,
 # since we're often dealing with big folders and large numbers of messages.
 
 imaplib._MAXLINE = max(10_000_000, imaplib._MAXLINE)
 
+# Servers are only required to accept command lines of around 8000 octets
+# (RFC 7162 section 4), so keep the UID sets we send comfortably below that.
+MAX_UID_SET_LENGTH = 7000
+
 class ImapDedupException(Exception):
     pass
 
 
+class ConnectionFailed(Exception):
+    """
+    Raised by connect() when it can't connect or log in, having already
+    said why. It's separate from ImapDedupException so that it isn't
+    mistaken for a problem with one mailbox.
+    """
+    pass
+
+
+# The errors that mean the connection to the server dropped, rather than
+# something like a file we couldn't open, so --retries can try again
+CONNECTION_ERRORS = (imaplib.IMAP4.abort, ConnectionError, socket.timeout, socket.gaierror)
+
+
 def check_response(resp: Tuple[str, List[bytes]]):
     """
     IMAP responses should normally begin 'OK'. Strip that off, or raise
@@ -79,6 +117,12 @@ def get_arguments(args: Optional[List[str]] = None) -> Tuple[argparse.Namespace,
     parser.add_argument("-p", "--port", dest="port", help="IMAP server port", type=int)
     parser.add_argument("-x", "--ssl", dest="ssl", action="store_true", help="Use SSL")
     parser.add_argument("-X", "--starttls", dest="starttls", action="store_true", help="Require STARTTLS")
+    parser.add_argument(
+        "--no-compress",
+        dest="no_compress",
+        action="store_true",
+        help="Don't compress the connection, even if the server supports it (COMPRESS=DEFLATE)",
+    )
     parser.add_argument("-u", "--user", dest="user", help="IMAP user name")
     parser.add_argument("-a", "--authuser", dest='authuser', help='IMAP admin user')
     parser.add_argument(
@@ -118,18 +162,21 @@ def get_arguments(args: Optional[List[str]] = None) -> Tuple[argparse.Namespace,
     parser.add_argument(
         "--save-msg-list",
         dest="save_msg_list",
-        help="Save list of messages, subjects, senders, etc to a file",
+        help="Save list of messages, subjects, senders, etc to a file, as it goes. It's tab-separated, "
+             "gzipped if the name ends in .gz, or in Parquet format if it ends in .parquet "
+             "(which needs the pyarrow package)",
     )
     parser.add_argument(
         "-i",
         "--save-ids",
         dest="save_ids",
-        help="Save IDs of all messages found to a file",
+        help="Save IDs of all messages found to a file. Files ending .db or .sqlite are saved as an indexed "
+             "SQLite database, which --delete-ids can use without loading it all into memory",
     )
     parser.add_argument(
         "--delete-ids",
         dest="delete_ids",
-        help="Read a list of IDs and mark all of them for deletion if found on the server",
+        help="Read a list of IDs (text, or a database from --save-ids) and mark all of them for deletion if found on the server",
     )
     parser.add_argument(
         "-b",
@@ -144,6 +191,43 @@ def get_arguments(args: Optional[List[str]] = None) -> Tuple[argparse.Namespace,
         action="store_true",
         help="Include the Message-ID (if any) in the -c checksum.",
     )
+    parser.add_argument(
+        "--hash",
+        dest="hash",
+        choices=CHECKSUM_HASHES,
+        help="Hash to use for the -c checksum (default blake2b). 'xxh128' needs the xxhash package. "
+             "'legacy' is the md5|sha256|sha3 format used by earlier versions, which is picked "
+             "automatically if the --delete-ids file was saved in that format.",
+    )
+    parser.add_argument(
+        "--content",
+        dest="content_bytes",
+        type=int,
+        metavar="BYTES",
+        help="Add each message's size and the first BYTES bytes of its body to the -c checksum (implies -c), "
+             "so copies whose Message-ID was changed on the way still match, and different messages "
+             "with the same headers don't",
+    )
+    parser.add_argument(
+        "--server-ids",
+        dest="server_ids",
+        action="store_true",
+        help="Use the IDs that some servers assign to each message's content (EMAILID, or X-GM-MSGID on Gmail) "
+             "instead of reading headers, when available",
+    )
+    parser.add_argument(
+        "--same-size",
+        dest="same_size",
+        action="store_true",
+        help="Only count messages of the same size (RFC822.SIZE) as duplicates. Sizes are fetched first, "
+             "and headers only for the messages whose size matches another's",
+    )
+    parser.add_argument(
+        "--same-date",
+        dest="same_date",
+        action="store_true",
+        help="Likewise for the date and time the server received each message (INTERNALDATE)",
+    )
     parser.add_argument(
         "--no-close",
         dest="no_close",
@@ -183,12 +267,101 @@ def get_arguments(args: Optional[List[str]] = None) -> Tuple[argparse.Namespace,
         "-y", "--copy", dest="copy_mailbox",
         help="Copy messages to specified mailbox before deleting them from current location."
     )
+    parser.add_argument(
+        "--pipeline",
+        dest="pipeline",
+        type=int,
+        default=1,
+        help="Number of header FETCH commands to keep in flight at once (default 1). "
+             "Higher values help a lot on high-latency connections.",
+    )
+    parser.add_argument(
+        "--batch-min",
+        dest="batch_min",
+        type=int,
+        default=10,
+        help="Smallest number of messages to fetch headers for at once (default 10)",
+    )
+    parser.add_argument(
+        "--batch-max",
+        dest="batch_max",
+        type=int,
+        default=2000,
+        help="Largest number of messages to fetch headers for at once (default 2000)",
+    )
+    parser.add_argument(
+        "--batch-seconds",
+        dest="batch_seconds",
+        type=float,
+        default=2.0,
+        help="Grow header batches while each takes less than this many seconds (default 2)",
+    )
+    parser.add_argument(
+        "--batch-bytes",
+        dest="batch_bytes",
+        type=int,
+        default=4_000_000,
+        help="Shrink header batches if one returns more than this many bytes (default 4000000)",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        dest="jobs",
+        type=int,
+        default=1,
+        help="Scan up to this many mailboxes at once, each over its own connection (default 1)",
+    )
+    parser.add_argument(
+        "--cache",
+        dest="cache",
+        help="Cache message IDs in this file, so later runs only fetch headers for new messages",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        dest="checkpoint",
+        help="Record progress in this file as we go, so an interrupted run can be resumed",
+    )
+    parser.add_argument(
+        "--resume",
+        dest="resume",
+        action="store_true",
+        help="Carry on from the --checkpoint file left by an interrupted run",
+    )
+    parser.add_argument(
+        "--retries",
+        dest="retries",
+        type=int,
+        default=3,
+        help="With --checkpoint, how many times to reconnect and resume if the connection drops (default 3)",
+    )
+    parser.add_argument(
+        "--metrics",
+        dest="metrics",
+        help="Append timing, round trip and byte counts for each mailbox and phase to this file, as JSON lines",
+    )
+    parser.add_argument(
+        "--profile",
+        dest="profile",
+        help="Run under cProfile and save the stats to this file (only covers the main connection's thread)",
+    )
+    parser.add_argument(
+        "--local",
+        dest="local_sources",
+        action="append",
+        default=[],
+        metavar="PATH",
+        help="Also look through this local Maildir directory or mbox file, after any IMAP mailboxes "
+             "(can be given more than once)",
+    )
     parser.add_argument('mailbox', nargs='*')
 
     options = parser.parse_args(args)
     mboxes = options.mailbox
 
-    if ((not options.server) or (not options.user)) and not options.process:
+    # Only local sources don't need a server
+    options.uses_server = bool(mboxes or options.just_list or options.save_list or not options.local_sources)
+
+    if ((not options.server) or (not options.user)) and not options.process and options.uses_server:
         sys.stderr.write(
             "\nError: Must specify server, user, and at least one mailbox.\n\n"
         )
@@ -199,10 +372,90 @@ def get_arguments(args: Optional[List[str]] = None) -> Tuple[argparse.Namespace,
         sys.stderr.write("\nError: You can only specify one mailbox if you use -r.\n")
         sys.exit(1)
 
+    if options.content_bytes is not None:
+        if options.content_bytes < 0:
+            sys.stderr.write("\nError: --content can't be negative.\n")
+            sys.exit(1)
+        if options.local_sources:
+            sys.stderr.write("\nError: --content can't be used with --local.\n")
+            sys.exit(1)
+        options.use_checksum = True
+
     if options.use_id_in_checksum and not options.use_checksum:
         sys.stderr.write("\nError: If you use -m you must also use -c.\n")
         sys.exit(1)
 
+    if options.server_ids and options.use_checksum:
+        sys.stderr.write("\nError: You can't use --server-ids with -c or --content.\n")
+        sys.exit(1)
+
+    if (options.same_size or options.same_date) and (
+        options.save_ids or options.delete_ids or options.save_msg_list or options.local_sources
+    ):
+        # Messages that can't have a duplicate are never read at all
+        sys.stderr.write("\nError: --same-size and --same-date can't be used with -i, --delete-ids, "
+                         "--save-msg-list or --local.\n")
+        sys.exit(1)
+
+    if options.hash and not options.use_checksum:
+        sys.stderr.write("\nError: If you use --hash you must also use -c.\n")
+        sys.exit(1)
+
+    if options.use_checksum:
+        # IDs saved by earlier versions can only be matched by the same hash
+        legacy_ids = options.delete_ids and is_legacy_id_file(options.delete_ids)
+        if options.hash is None:
+            options.hash = "legacy" if legacy_ids else "blake2b"
+            if legacy_ids:
+                print(f"{options.delete_ids} contains checksums in the legacy format; using --hash legacy")
+        elif legacy_ids and options.hash != "legacy":
+            sys.stderr.write(
+                f"\nError: {options.delete_ids} contains checksums in the legacy format,"
+                " which can only be matched with --hash legacy.\n"
+            )
+            sys.exit(1)
+        if options.hash == "xxh128":
+            import xxhash
+
+    if options.save_msg_list and options.save_msg_list.endswith(".parquet"):
+        import pyarrow.parquet
+
+    if options.pipeline < 1:
+        sys.stderr.write("\nError: --pipeline must be at least 1.\n")
+        sys.exit(1)
+
+    if not 1 <= options.batch_min <= options.batch_max:
+        sys.stderr.write("\nError: --batch-min must be at least 1, and no more than --batch-max.\n")
+        sys.exit(1)
+
+    if options.jobs < 1:
+        sys.stderr.write("\nError: --jobs must be at least 1.\n")
+        sys.exit(1)
+
+    if options.resume and not options.checkpoint:
+        sys.stderr.write("\nError: If you use --resume you must also use --checkpoint.\n")
+        sys.exit(1)
+
+    if options.retries < 0:
+        sys.stderr.write("\nError: --retries can't be negative.\n")
+        sys.exit(1)
+
+    if options.local_sources and options.server_ids:
+        # Local messages have no server IDs, so they'd be keyed differently and never match
+        parser.error("--server-ids can't be used with --local sources")
+
+    for path in options.local_sources:
+        kind = local_mailbox_kind(path)
+        if kind is None:
+            sys.stderr.write(f"\nError: {path} is not a Maildir directory or mbox file.\n")
+            sys.exit(1)
+        if options.tag_name or options.copy_mailbox:
+            sys.stderr.write("\nError: -t and -y can't be used with local sources.\n")
+            sys.exit(1)
+        if kind == "mbox" and not (options.dry_run or options.save_ids or options.save_msg_list):
+            sys.stderr.write(f"\nError: mbox files like {path} are only read, so use -n, -i or --save-msg-list.\n")
+            sys.exit(1)
+
     if options.keyring == '':
         options.keyring = options.server
 
@@ -210,13 +463,33 @@ def get_arguments(args: Optional[List[str]] = None) -> Tuple[argparse.Namespace,
         import keyring
         options.password = keyring.get_password(options.keyring, options.user)
 
-    if not options.password and not options.process:
+    if not options.password and not options.process and options.uses_server:
         # Read from IMAPDEDUP_PASSWORD env variable, or prompt for one.
-        options.password = os.getenv("IMAPDEDUP_PASSWORD") or getpass.getpass()
+        options.password = os.getenv("IMAPDEDUP_PASSWORD") or ask_password(options.server, options.user)
 
     return (options, mboxes)
 
 
+# Passwords typed in so far, by (server, user), so each is only asked for once
+entered_passwords: Dict[Tuple[str, str], str] = {}
+
+
+def ask_password(server: str, user: str) -> str:
+    """
+    Prompt for the password of an account, unless it's been given already.
+    Jobs run side by side by run_accounts() can't share the terminal, so
+    they have to have been given theirs beforehand.
+    """
+    password = entered_passwords.get((server, user))
+    if password is None:
+        if account_output.get() is not None:
+            sys.stderr.write(f"\nError: No password for {user} on {server}, "
+                             "and jobs running in parallel can't ask for one.\n")
+            sys.exit(1)
+        password = entered_passwords[(server, user)] = getpass.getpass(f"Password for {user} on {server}: ")
+    return password
+
+
 # Thanks to http://www.doughellmann.com/PyMOTW/imaplib/
 list_response_pattern = re.compile(
     rb'\((?P<flags>.*?)\) "(?P<delimiter>.*)" (?P<name>.*)'
@@ -242,12 +515,7 @@ def other_encodings(header_list):
 
 
 def is_ascii(bytes):
-    ''' There must be a better way to do this.
-    '''
-    for b in bytes:
-        if b > 127:
-            return False
-    return True
+    return bytes.isascii()
 
 
 # a whole mess of em: https://gist.github.com/tushortz/9fbde5d023c0a0204333267840b592f9
@@ -269,20 +537,150 @@ COMMON_UTF8 = set([
     b'\xf0\x9f\x8d\xb7',  # wine emoji
 ])
 
+common_utf8_pattern = re.compile(b"|".join(re.escape(entry) for entry in COMMON_UTF8))
+
 def has_common_utf8(bytes):
-    for entry in COMMON_UTF8:
-        if entry in bytes:
-            return True
-    return False
+    return common_utf8_pattern.search(bytes) is not None
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Let through at most `burst` records with the same format string in
+    each `interval` seconds, so a mailbox full of oddly encoded headers
+    doesn't bury everything else. The next record to get through after
+    some were dropped says how many.
+    """
+
+    def __init__(self, burst: int = 5, interval: float = 60.0):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self.windows: Dict[str, List[float]] = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        now = time.monotonic()
+        with self.lock:
+            window = self.windows.setdefault(str(record.msg), [now, 0, 0])
+            if now - window[0] >= self.interval:
+                window[:2] = [now, 0]
+            window[1] += 1
+            if window[1] > self.burst:
+                window[2] += 1
+                return False
+            suppressed, window[2] = window[2], 0
+        if suppressed:
+            record.msg = f"{record.msg}\n({suppressed} similar messages suppressed)"
+        return True
+
+
+log = logging.getLogger("imapdedup")
+log.addFilter(RateLimitFilter())
+
+
+# How email.feedparser splits lines and recognises header lines
+header_lines_pattern = re.compile(r".*?(?:\r\n|\r|\n)|.+", re.DOTALL)
+header_name_pattern = re.compile(r"[\041-\071\073-\176]+:")
+
+
+class HeaderBlock:
+    """
+    Just the header fields we're interested in from a raw header block.
+
+    This stands in for the email.message.Message that BytesParser would
+    build, supporting the parts of it that we use: get(), [] and str().
+    The values are exactly those that Message.get() would return, ready
+    for str_header() to decode, but getting them is much quicker.
+    """
+
+    def __init__(self, text: str, fields: Dict[str, Tuple[str, str]]):
+        self.text = text
+        self.fields = fields
+
+    def get(self, name: str, failobj: Any = None) -> Any:
+        field = self.fields.get(name.lower())
+        if field is None:
+            return failobj
+        # This is what turns values with 8-bit bytes into Header objects
+        return compat32.header_fetch_parse(*field)
+
+    def __getitem__(self, name: str) -> Any:
+        return self.get(name)
+
+    def __str__(self) -> str:
+        return self.text
+
+
+def scan_header_fields(raw: bytes, wanted: Iterable[str]) -> Optional[HeaderBlock]:
+    """
+    Pull the wanted fields (lower-case names) out of a raw header block,
+    following the same rules as email.feedparser with the compat32 policy:
+    folded continuation lines are joined with their line breaks intact, and
+    only the first instance of each field counts.
+
+    Returns None if the block contains anything unusual, such as a line
+    that isn't a valid header, so the caller can fall back to BytesParser.
+    """
+    wanted = set(wanted)
+    text = raw.decode("ascii", "surrogateescape")
+    found: Dict[str, List[str]] = {}
+    current: Optional[List[str]] = None
+    for line in header_lines_pattern.findall(text):
+        if line[0] in " \t":
+            if not found and current is None:
+                return None  # continuation with nothing to continue
+            if current is not None:
+                current.append(line)
+            continue
+        if line in ("\r\n", "\n", "\r"):
+            break  # end of the headers
+        if line.startswith("From ") or not header_name_pattern.match(line):
+            return None
+        name = line[:line.index(":")].lower()
+        if name in wanted and name not in found:
+            current = found[name] = [line]
+        else:
+            current = None
+            found.setdefault(name, [])
+
+    fields: Dict[str, Tuple[str, str]] = {}
+    for name, lines in found.items():
+        if lines:
+            fields[name] = compat32.header_source_parse(lines)
+    return HeaderBlock(text, fields)
+
+
+def parse_headers(raw: bytes, wanted: Iterable[str], parser: BytesParser) -> Union[Message, HeaderBlock]:
+    """
+    Parse a header block quickly for the wanted fields if we can, or
+    fully with BytesParser if it's malformed in some way.
+    """
+    block = scan_header_fields(raw, wanted)
+    if block is None:
+        return parser.parsebytes(raw)
+    return block
 
 
-def str_header(parsed_message: Message, name: str) -> str:
+def str_header(parsed_message: Union[Message, HeaderBlock], name: str) -> str:
     """"
     Return the value (of the first instance, if more than one) of
     the given header, as a unicode string.
     """
+    value = parsed_message.get(name, "")
+    if type(value) is not str:
+        return decode_header_value(value, name)  # has 8-bit bytes
+    if "=?" not in value:
+        return value  # nothing encoded, so decode_header would return it as-is
+    return decode_cached_header_value(value, name)
+
+
+def decode_header_value(value: Any, name: str) -> str:
+    """
+    Decode a header value, which may have RFC 2047 encoded words or
+    8-bit bytes in it, to a unicode string.
+    """
     # print()
-    hdrlist = decode_header(parsed_message.get(name, ""))
+    hdrlist = decode_header(value)
     # print(hdrlist)
 
     # if len(hdrlist) > 1 and name != 'From':
@@ -312,47 +710,92 @@ def str_header(parsed_message: Message, name: str) -> str:
             maybe = btext.decode(charset)
             # print(f'unknown-8bit encoding: converted {btext} to {maybe}')
             if not is_ascii(btext) and not has_common_utf8(btext):
-                print('found unknown-8bit encoding')
-                print(btext)
-                print(maybe)
-                print()
+                log.warning("found unknown-8bit encoding\n%r\n%s\n", btext, maybe)
             decoded += maybe
         else:
             decoded += btext.decode('utf-8')  # probably ASCII, but...
     if len(hdrlist) > 1 and name != 'From':
         if other_encodings(hdrlist):
-            print(f'{len(hdrlist)} headers for {name}')
-            print(hdrlist)
-            print(f'Decoded to: {decoded}')
-            print()
+            log.warning("%d headers for %s\n%r\nDecoded to: %s\n", len(hdrlist), name, hdrlist, decoded)
     return decoded
 
 
+# From and Subject values repeat a lot in mailing list folders
+decode_cached_header_value = lru_cache(maxsize=4096)(decode_header_value)
+
+
+CHECKSUM_HASHES = ["blake2b", "sha256", "xxh128", "legacy"]
+
+# Checksums in the format used before --hash existed
+legacy_id_pattern = re.compile(r"^[0-9a-f]{32}\|[0-9a-f]{64}\|[0-9a-f]{64}$")
+
+
+class LegacyChecksum:
+    """
+    The md5, sha256 and sha3-256 hashes of the same data, joined with '|'.
+    This is how -c checksums were computed before the --hash option.
+    """
+
+    def __init__(self):
+        self.hashes = [hashlib.md5(), hashlib.sha256(), hashlib.sha3_256()]
+
+    def update(self, data: bytes):
+        for h in self.hashes:
+            h.update(data)
+
+    def hexdigest(self) -> str:
+        return "|".join(h.hexdigest() for h in self.hashes)
+
+
+def new_checksum(hash_name: str) -> Any:
+    """
+    Return a new hash object of the kind named by the --hash option.
+    """
+    if hash_name == "blake2b":
+        return hashlib.blake2b(digest_size=16)
+    if hash_name == "sha256":
+        return hashlib.sha256()
+    if hash_name == "xxh128":
+        import xxhash
+        return xxhash.xxh3_128()
+    if hash_name == "legacy":
+        return LegacyChecksum()
+    raise ValueError(f"Unknown hash: {hash_name}")
+
+
+def is_legacy_id_file(path: str) -> bool:
+    """
+    Check whether a saved ID file holds checksums in the legacy format,
+    judging by its first entry.
+    """
+    msg_id = first_saved_id(path)
+    return msg_id is not None and bool(legacy_id_pattern.match(msg_id))
+
+
 def get_message_id(
-    parsed_message: Message, options_use_checksum=False, options_use_id_in_checksum=False
+    parsed_message: Union[Message, HeaderBlock], options_use_checksum=False, options_use_id_in_checksum=False,
+    options_hash="blake2b", content: Iterable[bytes] = (),
 ) -> Optional[str]:
     """
     Normally, return the Message-ID header (or print a warning if it doesn't
     exist and return None).
 
-    If options_use_checksum is specified, use md5 hash of several headers
-    instead.
+    If options_use_checksum is specified, use a hash of several headers
+    instead, returned as a hex string. options_hash names the kind of hash.
 
     For more safety, user should first do a dry run, reviewing them before
-    deletion. Problems are extremely unlikely, but md5 is not collision-free.
+    deletion. Problems are extremely unlikely, but hashes are not collision-free.
 
     If options_use_id_in_checksum is specified, then the Message-ID will be
     included in the header checksum, otherwise it is excluded.
+
+    Any content given (see get_content()) is added to the checksum after
+    the headers.
     """
     try:
         if options_use_checksum:
-            md5 = hashlib.md5()
-            sha = hashlib.sha256()
-            sha3 = hashlib.sha3_256()
-            def update(x):
-                md5.update(x)
-                sha.update(x)
-                sha3.update(x)
+            checksum = new_checksum(options_hash)
+            update = checksum.update
             update(("From:" + str_header(parsed_message, "From")).encode())
             update(("To:" + str_header(parsed_message, "To")).encode())
             update(("Subject:" + str_header(parsed_message, "Subject")).encode())
@@ -361,7 +804,9 @@ def get_message_id(
             update(("Bcc:" + str_header(parsed_message, "Bcc")).encode())
             if options_use_id_in_checksum:
                 update(("Message-ID:" + str_header(parsed_message, "Message-ID")).encode())
-            msg_id = md5.hexdigest() + "|" + sha.hexdigest() + "|" + sha3.hexdigest()
+            for data in content:
+                update(data)
+            msg_id = checksum.hexdigest()
             # print(msg_id)
         else:
             msg_id = str_header(parsed_message, "Message-ID")
@@ -398,6 +843,430 @@ def get_message_id(
         return None
 
 
+class MessageIndex:
+    """
+    A set of message IDs, optionally recording for each the mailbox number
+    and UID of the message where it was first seen.
+
+    Storing millions of ID strings in a dict takes gigabytes, so instead
+    we keep a fixed-size digest of each ID in one flat bytearray, and the
+    location packed into a 64-bit int in a parallel array, as an open
+    addressing hash table. That comes to a few dozen bytes per message.
+    """
+
+    DIGEST_SIZE = 16
+    EMPTY = 0  # UIDs start at 1, so no real packed location is ever 0
+    NO_LOCATION = 2 ** 64 - 1
+
+    def __init__(self, capacity: int = 1024):
+        self._capacity = 1
+        while self._capacity < capacity:
+            self._capacity *= 2
+        self._digests = bytearray(self._capacity * self.DIGEST_SIZE)
+        self._locations = array("Q", bytes(8 * self._capacity))
+        self._count = 0
+
+    @classmethod
+    def digest(cls, msg_id: str) -> bytes:
+        return hashlib.blake2b(msg_id.encode(), digest_size=cls.DIGEST_SIZE).digest()
+
+    def _find(self, digest: bytes) -> int:
+        """
+        Return the slot holding this digest, or the empty slot where it would go.
+        """
+        size = self.DIGEST_SIZE
+        mask = self._capacity - 1
+        slot = int.from_bytes(digest[:8], "little") & mask
+        while True:
+            if self._locations[slot] == self.EMPTY:
+                return slot
+            if self._digests[slot * size: (slot + 1) * size] == digest:
+                return slot
+            slot = (slot + 1) & mask
+
+    def _grow(self):
+        old_digests, old_locations = self._digests, self._locations
+        self._capacity *= 2
+        self._digests = bytearray(self._capacity * self.DIGEST_SIZE)
+        self._locations = array("Q", bytes(8 * self._capacity))
+        size = self.DIGEST_SIZE
+        for old_slot, location in enumerate(old_locations):
+            if location != self.EMPTY:
+                digest = bytes(old_digests[old_slot * size: (old_slot + 1) * size])
+                slot = self._find(digest)
+                self._digests[slot * size: (slot + 1) * size] = digest
+                self._locations[slot] = location
+
+    def set(self, msg_id: str, mbox_index: Optional[int] = None, uid: Optional[int] = None) -> bool:
+        """
+        Record the ID, and where it was found if given, replacing any earlier
+        location. Returns True if the ID wasn't already in the index.
+        """
+        if mbox_index is None or uid is None:
+            location = self.NO_LOCATION
+        else:
+            location = (mbox_index << 32) | uid
+        digest = self.digest(msg_id)
+        slot = self._find(digest)
+        is_new = self._locations[slot] == self.EMPTY
+        if is_new:
+            if (self._count + 1) * 3 > self._capacity * 2:
+                self._grow()
+                slot = self._find(digest)
+            size = self.DIGEST_SIZE
+            self._digests[slot * size: (slot + 1) * size] = digest
+            self._count += 1
+        self._locations[slot] = location
+        return is_new
+
+    def get(self, msg_id: str) -> Optional[Tuple[int, int]]:
+        """
+        Return the (mailbox number, UID) where the ID was recorded, or None
+        if it isn't in the index or was recorded without a location.
+        """
+        location = self._locations[self._find(self.digest(msg_id))]
+        if location == self.EMPTY or location == self.NO_LOCATION:
+            return None
+        return (location >> 32, location & 0xFFFFFFFF)
+
+    def __contains__(self, msg_id: str) -> bool:
+        return self._locations[self._find(self.digest(msg_id))] != self.EMPTY
+
+    def __len__(self) -> int:
+        return self._count
+
+
+ID_STORE_EXTENSIONS = (".db", ".sqlite", ".sqlite3")
+
+
+def is_id_store(path: str) -> bool:
+    """
+    Should this ID file be an IdStore rather than a plain list of IDs?
+    Existing files are recognised by their contents, new ones by their extension.
+    """
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            return f.read(16) == b"SQLite format 3\x00"
+    return path.lower().endswith(ID_STORE_EXTENSIONS)
+
+
+class IdStore:
+    """
+    A set of message IDs kept in an SQLite database, indexed by the same
+    digest that MessageIndex uses, so it can be appended to as we go and
+    checked one ID at a time without loading the whole thing into memory.
+    Set operations between stores happen inside SQLite, too.
+    """
+
+    BATCH_SIZE = 10_000
+
+    def __init__(self, path: str):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS ids (digest BLOB PRIMARY KEY, id TEXT NOT NULL) WITHOUT ROWID"
+        )
+        self.pending: List[Tuple[bytes, str]] = []
+
+    def add(self, msg_id: str):
+        self.pending.append((MessageIndex.digest(msg_id), msg_id))
+        if len(self.pending) >= self.BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.db.executemany("INSERT OR IGNORE INTO ids VALUES (?, ?)", self.pending)
+            self.db.commit()
+            self.pending = []
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+    def __contains__(self, msg_id: str) -> bool:
+        self.flush()
+        row = self.db.execute(
+            "SELECT 1 FROM ids WHERE digest = ?", (MessageIndex.digest(msg_id),)
+        ).fetchone()
+        return row is not None
+
+    def __len__(self) -> int:
+        self.flush()
+        return self.db.execute("SELECT COUNT(*) FROM ids").fetchone()[0]
+
+    def __iter__(self) -> Iterator[str]:
+        self.flush()
+        for (msg_id,) in self.db.execute("SELECT id FROM ids"):
+            yield msg_id
+
+    def _compare(self, other: "IdStore", operator: str) -> Iterator[str]:
+        self.flush()
+        other.flush()
+        self.db.execute("ATTACH DATABASE ? AS other", (other.path,))
+        try:
+            query = f"SELECT id FROM ids WHERE digest {operator} (SELECT digest FROM other.ids)"
+            for (msg_id,) in self.db.execute(query):
+                yield msg_id
+        finally:
+            self.db.execute("DETACH DATABASE other")
+
+    def difference(self, other: "IdStore") -> Iterator[str]:
+        """
+        Yield the IDs in this store that aren't in the other one.
+        """
+        return self._compare(other, "NOT IN")
+
+    def intersection(self, other: "IdStore") -> Iterator[str]:
+        """
+        Yield the IDs that are in both stores.
+        """
+        return self._compare(other, "IN")
+
+    def match(self, other: "IdStore") -> Iterator[Tuple[str, bool]]:
+        """
+        Yield each ID in this store along with whether it's in the other one.
+        """
+        self.flush()
+        other.flush()
+        self.db.execute("ATTACH DATABASE ? AS other", (other.path,))
+        try:
+            query = "SELECT id, digest IN (SELECT digest FROM other.ids) FROM ids"
+            for msg_id, found in self.db.execute(query):
+                yield msg_id, bool(found)
+        finally:
+            self.db.execute("DETACH DATABASE other")
+
+
+class IdListFile:
+    """
+    The plain-text alternative to IdStore for saving IDs: one per line,
+    in the order they're added.
+    """
+
+    def __init__(self, path: str):
+        self.file = open(path, "wt")
+
+    def add(self, msg_id: str):
+        print(msg_id, file=self.file)
+
+    def close(self):
+        self.file.close()
+
+
+class MessageListWriter:
+    """
+    Writes the --save-msg-list rows as they're found, so they don't build
+    up in memory, and what was found so far is kept if a run fails.
+
+    The format depends on the file name: tab-separated text, gzipped if
+    it ends in .gz, or Parquet if it ends in .parquet, whose rows are
+    written out in groups of batch_size.
+
+    Each batch of headers adds its rows as soon as it's been parsed, so
+    with --jobs the rows from mailboxes being scanned at the same time
+    are interleaved batch by batch.
+    """
+
+    COLUMNS = ["from", "email", "subject", "date"]
+
+    def __init__(self, path: str, batch_size: int = 100_000):
+        self.batch_size = batch_size
+        self.rows: List[List[str]] = []
+        self.parquet: Any = None
+        self.file: Any = None
+        self.lock = threading.Lock()
+        if path.endswith(".parquet"):
+            import pyarrow
+            import pyarrow.parquet
+            self.schema = pyarrow.schema([(name, pyarrow.string()) for name in self.COLUMNS])
+            self.parquet = pyarrow.parquet.ParquetWriter(path, self.schema)
+        else:
+            self.file = gzip.open(path, "wt") if path.endswith(".gz") else open(path, "wt")
+            print("\t".join(self.COLUMNS), file=self.file)
+
+    def add(self, rows: List[List[str]]):
+        with self.lock:
+            if self.file is not None:
+                for row in rows:
+                    print("\t".join(row), file=self.file)
+                return
+            self.rows += rows
+            if len(self.rows) >= self.batch_size:
+                self.flush()
+
+    def flush(self):
+        if self.parquet is not None and self.rows:
+            import pyarrow
+            columns = {name: [row[i] for row in self.rows] for i, name in enumerate(self.COLUMNS)}
+            self.parquet.write_table(pyarrow.table(columns, schema=self.schema))
+            self.rows = []
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+            else:
+                self.flush()
+                self.parquet.close()
+
+
+def get_message_list_row(parsed_message: Union[Message, HeaderBlock]) -> List[str]:
+    """
+    The --save-msg-list row for a message: who it's from, their address,
+    and its subject and date.
+    """
+    from_header = str_header(parsed_message, "From")
+    if '@' not in from_header:
+        print()
+        print('no email found in "from"')
+        print(parsed_message)
+        # exit(1)
+    if '<' in from_header and '>' in from_header:
+        from_email = from_header[from_header.index('<') + 1:from_header.index('>')]
+    else:
+        from_email = from_header
+
+    # weird order due to the specific use case
+    return [
+        from_header,
+        from_email,
+        str_header(parsed_message, "Subject"),
+        str_header(parsed_message, "Date")
+    ]
+
+
+def open_saved_ids(path: str) -> Any:
+    """
+    Open an ID file for --save-ids, as an IdStore or a plain list of IDs.
+    """
+    if is_id_store(path):
+        # We're replacing whatever was saved before, as with a text file
+        if os.path.exists(path):
+            os.remove(path)
+        return IdStore(path)
+    return IdListFile(path)
+
+
+def load_ids(path: str) -> Any:
+    """
+    Return the set of IDs in a saved file, for --delete-ids. An IdStore is
+    queried where it lies, while a text file is read into a MessageIndex.
+    """
+    if is_id_store(path):
+        return IdStore(path)
+    ids = MessageIndex()
+    with open(path) as f:
+        for line in f:
+            ids.set(line.strip())
+    return ids
+
+
+def iter_saved_ids(path: str) -> Iterator[str]:
+    """
+    Yield the IDs in a saved file, of either kind, without loading them all.
+    """
+    if is_id_store(path):
+        store = IdStore(path)
+        try:
+            yield from store
+        finally:
+            store.close()
+        return
+    with open(path) as f:
+        for line in f:
+            msg_id = line.strip()
+            if msg_id:
+                yield msg_id
+
+
+def sort_ids(ids: Iterable[str], path: str, chunk_size: int = 1_000_000) -> int:
+    """
+    Write the IDs to a text file in sorted order, without repeats, holding
+    no more than chunk_size of them in memory at once. Bigger collections
+    are sorted a chunk at a time into temporary files alongside, which are
+    then merged. Returns the number of IDs written.
+    """
+    runs: List[Any] = []
+
+    def save_run(chunk: List[str]):
+        chunk.sort()
+        run = tempfile.TemporaryFile("w+t", dir=os.path.dirname(os.path.abspath(path)))
+        run.writelines(msg_id + "\n" for msg_id in chunk)
+        run.seek(0)
+        runs.append(run)
+
+    try:
+        chunk: List[str] = []
+        for msg_id in ids:
+            chunk.append(msg_id)
+            if len(chunk) >= chunk_size:
+                save_run(chunk)
+                chunk = []
+        if runs:
+            save_run(chunk)
+            merged: Iterable[str] = heapq.merge(*((line[:-1] for line in run) for run in runs))
+        else:
+            chunk.sort()
+            merged = chunk
+
+        count = 0
+        previous = None
+        with open(path, "wt") as f:
+            for msg_id in merged:
+                if msg_id != previous:
+                    f.write(msg_id + "\n")
+                    count += 1
+                    previous = msg_id
+        return count
+    finally:
+        for run in runs:
+            run.close()
+
+
+def match_saved_ids(path: str, other_path: str, chunk_size: int = 1_000_000) -> Iterator[Tuple[str, bool]]:
+    """
+    Yield each ID saved in one file with whether it's also in the other,
+    without loading either into memory. Two IdStores are compared within
+    SQLite. Otherwise both are sorted on disk with sort_ids() and then
+    walked through side by side, in which case the IDs come out in order.
+    """
+    if is_id_store(path) and is_id_store(other_path):
+        store, other = IdStore(path), IdStore(other_path)
+        try:
+            yield from store.match(other)
+        finally:
+            store.close()
+            other.close()
+        return
+
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile("w+t", dir=directory) as ours, \
+            tempfile.NamedTemporaryFile("w+t", dir=directory) as theirs:
+        sort_ids(iter_saved_ids(path), ours.name, chunk_size)
+        sort_ids(iter_saved_ids(other_path), theirs.name, chunk_size)
+        with open(ours.name) as f, open(theirs.name) as g:
+            other_ids = (line[:-1] for line in g)
+            other_id = next(other_ids, None)
+            for line in f:
+                msg_id = line[:-1]
+                while other_id is not None and other_id < msg_id:
+                    other_id = next(other_ids, None)
+                yield msg_id, msg_id == other_id
+
+
+def first_saved_id(path: str) -> Optional[str]:
+    if is_id_store(path):
+        store = IdStore(path)
+        try:
+            return next(iter(store), None)
+        finally:
+            store.close()
+    with open(path) as f:
+        for line in f:
+            return line.strip()
+    return None
+
+
 def get_mailbox_list(server: imaplib.IMAP4, directory: str = '""', pattern: str = '"*"') -> List[str]:
     """
     Return a list of usable mailbox names which match the pattern.
@@ -412,94 +1281,953 @@ def get_mailbox_list(server: imaplib.IMAP4, directory: str = '""', pattern: str
     return resp
 
 
+esearch_tag_pattern = re.compile(r'^\(TAG "[^"]*"\)\s*')
+
+
+def has_esearch(server: imaplib.IMAP4) -> bool:
+    """
+    Whether the server supports RFC 4731 ESEARCH, which can return just a
+    count, or the matches as a compact sequence set.
+    """
+    return "ESEARCH" in server.capabilities
+
+
+def parse_esearch_response(data: bytes) -> Dict[str, str]:
+    """
+    Return the results in an ESEARCH response by name, e.g.
+    '(TAG "A5") UID COUNT 17 ALL 4:18,21' gives {'COUNT': '17', 'ALL': '4:18,21'}.
+    """
+    tokens = esearch_tag_pattern.sub("", data.decode()).split()
+    if tokens and tokens[0].upper() == "UID":
+        tokens = tokens[1:]
+    return {tokens[i].upper(): tokens[i + 1] for i in range(0, len(tokens) - 1, 2)}
+
+
+def esearch(server: imaplib.IMAP4, query: str, returns: str) -> Dict[str, str]:
+    """
+    Run a UID SEARCH asking for just the given results (e.g. 'COUNT').
+    The server must support ESEARCH.
+    """
+    # imaplib's uid() only looks for SEARCH responses, so we go a level lower
+    typ, dat = server._simple_command("UID", "SEARCH", "RETURN", f"({returns})", query)
+    results: Dict[str, str] = {}
+    for data in check_response(server._untagged_response(typ, dat, "ESEARCH")):
+        if data:
+            results.update(parse_esearch_response(data))
+    return results
+
+
 def get_matching_msgnums(server: imaplib.IMAP4, query: str, sent_before: Optional[str]) -> List[int]:
     """
-    Return a list of ids of deleted messages in the folder.
+    Return a list of UIDs of messages in the folder matching the query.
     """
     resp = []
     if (sent_before is not None):
         query = f"{query} SENTBEFORE {sent_before}"
         print(f"Getting matching messages sent before {sent_before}")
-    deleted_info = check_response(server.search(None, query))
+    if has_esearch(server):
+        # The matches come back as ranges, which is much shorter for big folders
+        return expand_uid_set(esearch(server, query, "ALL").get("ALL", ""))
+    deleted_info = check_response(server.uid("SEARCH", query))
     if deleted_info and deleted_info[0]:
         # If neither None nor empty nor [None], then
         # the first item should be a list of msg ids
         resp = [int(n) for n in deleted_info[0].split()]
     return resp
 
+def count_matching_msgs(server: imaplib.IMAP4, query: str, sent_before: Optional[str]) -> int:
+    """
+    Return the number of messages in the folder matching the query, without
+    fetching the full list of them if the server supports ESEARCH.
+    """
+    if not has_esearch(server):
+        return len(get_matching_msgnums(server, query, sent_before))
+    if sent_before is not None:
+        query = f"{query} SENTBEFORE {sent_before}"
+    return int(esearch(server, query, "COUNT").get("COUNT", 0))
+
+
 def get_deleted_msgnums(server: imaplib.IMAP4, sent_before: Optional[str]) -> List[int]:
     """
-    Return a list of ids of deleted messages in the folder.
+    Return a list of UIDs of deleted messages in the folder.
     """
     return get_matching_msgnums(server, "DELETED", sent_before)
 
 def get_undeleted_msgnums(server: imaplib.IMAP4, sent_before: Optional[str]) -> List[int]:
     """
-    Return a list of ids of non-deleted messages in the folder.
+    Return a list of UIDs of non-deleted messages in the folder.
     """
     return get_matching_msgnums(server, "UNDELETED", sent_before)
 
 def get_tagged_msgnums(server: imaplib.IMAP4, tag_name: str, sent_before: Optional[str]) -> List[int]:
     """
-    Return a list of ids of tagged messages in the folder.
+    Return a list of UIDs of tagged messages in the folder.
     """
     return get_matching_msgnums(server, f"KEYWORD {tag_name}", sent_before)
 
 
-def process_messages(server: imaplib.IMAP4, msgs_to_delete: List[int], tag_name: Optional[str] = None, copy_mailbox: Optional[str] = None):
+def uid_ranges(uids: Iterable[int]) -> List[Tuple[int, int]]:
+    """
+    Collapse a collection of UIDs into a sorted list of (first, last) ranges.
+    """
+    ranges: List[Tuple[int, int]] = []
+    for uid in sorted(set(uids)):
+        if ranges and ranges[-1][1] == uid - 1:
+            ranges[-1] = (ranges[-1][0], uid)
+        else:
+            ranges.append((uid, uid))
+    return ranges
+
+
+def format_uid_range(first: int, last: int) -> str:
+    return str(first) if first == last else f"{first}:{last}"
+
+
+def format_uid_set(uids: Iterable[int]) -> str:
+    """
+    Return an IMAP sequence set for the UIDs, e.g. '1:500,502,510:900'.
+    """
+    return ",".join(format_uid_range(first, last) for first, last in uid_ranges(uids))
+
+
+def expand_uid_set(uid_set: str) -> List[int]:
+    """
+    Return the sorted UIDs in an IMAP sequence set such as '1:500,502'.
+    """
+    uids: List[int] = []
+    for part in uid_set.split(","):
+        if not part:
+            continue
+        first, _, last = part.partition(":")
+        low, high = sorted((int(first), int(last or first)))
+        uids.extend(range(low, high + 1))
+    return sorted(set(uids))
+
+
+def batch_uid_sets(uids: Iterable[int], max_length: int = MAX_UID_SET_LENGTH) -> Iterator[Tuple[str, int]]:
+    """
+    Split the UIDs into as few sequence sets as possible, each no longer
+    than max_length characters. Yields (sequence_set, number_of_uids) pairs.
+    """
+    parts: List[str] = []
+    length = 0
+    count = 0
+    for first, last in uid_ranges(uids):
+        part = format_uid_range(first, last)
+        if parts and length + 1 + len(part) > max_length:
+            yield ",".join(parts), count
+            parts, length, count = [], 0, 0
+        parts.append(part)
+        length += len(part) + (1 if length else 0)
+        count += last - first + 1
+    if parts:
+        yield ",".join(parts), count
+
+
+def process_messages(server: imaplib.IMAP4, uid_set: str, tag_name: Optional[str] = None, copy_mailbox: Optional[str] = None):
     """
-    Actually do whatever we want to do to duplicates.
+    Actually do whatever we want to do to duplicates, given as a UID sequence set.
     Tag them with (\Deleted) or the specified tag_name.
     Copy them to another mailbox first if copy_mailbox specified.
     """
-    message_ids = ",".join(map(str, msgs_to_delete))
     action = tag_name or r"(\Deleted)"
     if copy_mailbox:
         check_response(
-            server.copy(message_ids, copy_mailbox)
+            server.uid("COPY", uid_set, copy_mailbox)
         )
+    # .SILENT saves the server from sending back the new flags of every message
     check_response(
-        server.store(message_ids, "+FLAGS", action)
+        server.uid("STORE", uid_set, "+FLAGS.SILENT", action)
     )
 
 
-def get_msg_headers(server: imaplib.IMAP4, msg_ids: List[int]) -> List[Tuple[int, bytes]]:
+fetch_uid_pattern = re.compile(rb'\bUID (\d+)')
+fetch_start_pattern = re.compile(rb'^\d+ \(')
+fetch_flags_pattern = re.compile(rb'\bFLAGS \(([^)]*)\)')
+fetch_size_pattern = re.compile(rb'\bRFC822\.SIZE (\d+)')
+fetch_date_pattern = re.compile(rb'\bINTERNALDATE "([^"]*)"')
+# The name of a literal in a FETCH response, e.g. BODY[TEXT]<0> {4096}
+fetch_literal_pattern = re.compile(rb'([A-Z0-9.]+\[[^\]]*\])(?:<\d+>)? \{(\d+)\}', re.I)
+
+# Server-provided message IDs that we can use instead of headers, keyed by the
+# capability that advertises them: RFC 8474 OBJECTID, and Gmail's extensions.
+SERVER_ID_ITEMS = {
+    "OBJECTID": "EMAILID",
+    "X-GM-EXT-1": "X-GM-MSGID",
+}
+server_id_patterns = {
+    "EMAILID": re.compile(rb'\bEMAILID \(([^)\s]+)\)'),
+    "X-GM-MSGID": re.compile(rb'\bX-GM-MSGID (\d+)'),
+}
+
+
+def get_server_id_item(server: imaplib.IMAP4) -> Optional[str]:
     """
-    Get the dict of headers for each message in the list of provided IDs.
-    Return a list of tuples:  [ (msgid, header_bytes), (msgid, header_bytes)... ]
-    The returned header_bytes can be parsed by
+    Return the FETCH item that gives a stable, server-assigned ID for each
+    message's content, or None if the server doesn't offer one.
     """
-    # Get the header info for each message
-    message_ids_str = ",".join(map(str, msg_ids))
-    ms = check_response(server.fetch(message_ids_str, "(RFC822.HEADER)"))
+    for capability, item in SERVER_ID_ITEMS.items():
+        if capability in server.capabilities:
+            return item
+    return None
 
-    # There are two lines per message in the response
-    resp: List[Tuple[int, bytes]] = []
-    for ci in range(len(ms) // 2):
-        mnum = int(msg_ids[ci])
-        _, hinfo = ms[ci * 2]
-        resp.append((mnum, hinfo))
-    return resp
 
+def get_header_fields(options, for_key: bool = True) -> List[str]:
+    """
+    Return the names of the headers we need to fetch, given the options:
+    those that make up the message ID (unless for_key is False), plus any
+    we're going to display or save.
+    """
+    fields = []
+    if not for_key:
+        pass
+    elif options.use_checksum:
+        fields = ["From", "To", "Subject", "Date", "Cc", "Bcc"]
+        if options.use_id_in_checksum:
+            fields.append("Message-ID")
+    else:
+        # Subject and Date are reported for messages with no Message-ID
+        fields = ["Message-ID", "Subject", "Date"]
+    if options.verbose:
+        fields += ["From", "To", "Cc", "Bcc", "Subject", "Date"]
+    if options.show or options.save_msg_list:
+        fields += ["From", "Subject", "Date"]
+    # Remove repeats, keeping the order
+    return list(dict.fromkeys(fields))
 
-def print_message_info(parsed_message: Message):
-    print("From: " + str_header(parsed_message, "From"))
-    print("To: " + str_header(parsed_message, "To"))
-    print("Cc: " + str_header(parsed_message, "Cc"))
-    print("Bcc: " + str_header(parsed_message, "Bcc"))
-    print("Subject: " + str_header(parsed_message, "Subject"))
-    print("Date: " + str_header(parsed_message, "Date"))
-    print("")
 
+def get_fetch_query(fields: List[str], id_item: Optional[str] = None, content_bytes: Optional[int] = None) -> str:
+    """
+    Return the FETCH items for the given header fields, plus the server ID
+    item if given, and the size and start of the body for --content.
 
-def add_quotes(mbox: str) -> str:
-    if " " in mbox and (mbox[0] != '"' or mbox[-1] != '"'):
-        mbox = '"' + mbox + '"'
-    return mbox
+    BODY.PEEK only transfers the named fields, rather than the whole header
+    block with all its Received and DKIM lines, and doesn't set the \\Seen flag.
+    A partial fetch like BODY.PEEK[TEXT]<0.4096> likewise only transfers that
+    many bytes of the body, however big the message is.
+    """
+    items = []
+    if id_item:
+        items.append(id_item)
+    if fields:
+        items.append("BODY.PEEK[HEADER.FIELDS (%s)]" % " ".join(f.upper() for f in fields))
+    if content_bytes is not None:
+        items.append("RFC822.SIZE")
+        if content_bytes > 0:
+            items.append("BODY.PEEK[TEXT]<0.%d>" % content_bytes)
+    return "(%s)" % " ".join(items)
+
+
+def send_fetch(server: imaplib.IMAP4, msg_ids: List[int], query: str) -> bytes:
+    """
+    Send a FETCH of the given items for each message in the list of provided
+    UIDs, without waiting for the response. Returns the command tag, to be
+    passed to read_fetch().
+    """
+    # imaplib has no public way to send a command without waiting for it to
+    # complete, so we use the same internals that its own methods do.
+    return server._command("UID", "FETCH", format_uid_set(msg_ids), query)
 
 
-# This actually does the work
-def process(options, mboxes: List[str]):
+def parse_fetch_response(ms: List[Any]) -> List[Tuple[int, bytes, Optional[bytes]]]:
+    """
+    Group the pieces of a FETCH response into one (uid, text, literal) tuple
+    per message, where text is everything apart from the literal, if any.
+
+    imaplib gives us an (envelope, literal) tuple followed by the rest of the
+    line for messages with a literal, or just a line for those without.
+    The UID may be in either part, depending on the server.
+
+    A message with more than one literal (e.g. headers and body for
+    --content) comes as several tuples before the rest of the line. Their
+    literals are joined into one, and split_fetch_literal() separates them.
+    """
+    records: List[Tuple[bytes, Optional[bytes]]] = []
+    awaiting_trailer = False
+    for item in ms:
+        if isinstance(item, tuple):
+            if awaiting_trailer and not fetch_start_pattern.match(item[0]):
+                text, literal = records[-1]
+                records[-1] = (text + item[0], (literal or b"") + item[1])
+            else:
+                records.append((item[0], item[1]))
+            awaiting_trailer = True
+        elif isinstance(item, bytes):
+            if awaiting_trailer and not fetch_start_pattern.match(item):
+                text, literal = records[-1]
+                records[-1] = (text + b" " + item, literal)
+            else:
+                records.append((item, None))
+            awaiting_trailer = False
+
+    resp: List[Tuple[int, bytes, Optional[bytes]]] = []
+    for text, literal in records:
+        m = fetch_uid_pattern.search(text)
+        if m is not None:
+            resp.append((int(m.group(1)), text, literal))
+    return resp
+
+
+def split_fetch_literal(text: bytes, literal: Optional[bytes]) -> Dict[bytes, bytes]:
+    """
+    Split the literal from parse_fetch_response() back into its parts,
+    keyed by the name of each, such as b"BODY[TEXT]". Servers may return
+    the items in any order, but the {size} after each name in the text
+    tells us where each one is.
+    """
+    parts = {}
+    pos = 0
+    for m in fetch_literal_pattern.finditer(text):
+        size = int(m.group(2))
+        parts[m.group(1).upper()] = (literal or b"")[pos:pos + size]
+        pos += size
+    return parts
+
+
+def get_content(text: bytes, parts: Dict[bytes, bytes]) -> List[bytes]:
+    """
+    Return what --content adds to a message's checksum, from its FETCH
+    response: its size and the start of its body.
+    """
+    m = fetch_size_pattern.search(text)
+    return [b"Size:" + (m.group(1) if m else b""), b"Body:" + parts.get(b"BODY[TEXT]", b"")]
+
+
+def read_fetch(server: imaplib.IMAP4, tag: bytes) -> List[Tuple[int, bytes, Optional[bytes]]]:
+    """
+    Wait for the FETCH with the given tag to complete, and return the
+    response for each message as parse_fetch_response() does.
+    """
+    typ, dat = server._command_complete("UID", tag)
+    return parse_fetch_response(check_response(server._untagged_response(typ, dat, "FETCH")))
+
+
+def get_msg_headers(server: imaplib.IMAP4, msg_ids: List[int], fields: List[str]) -> List[Tuple[int, bytes]]:
+    """
+    Get the given header fields for each message in the list of provided UIDs.
+    Return a list of tuples:  [ (uid, header_bytes), (uid, header_bytes)... ]
+    The returned header_bytes can be parsed by BytesParser.
+    They're fetched in batches, so that no one command gets too long.
+    """
+    return [
+        (uid, literal)
+        for _, records in iter_fetch(server, sorted(msg_ids), get_fetch_query(fields))
+        for uid, _, literal in records
+        if literal is not None
+    ]
+
+
+class BatchSizer:
+    """
+    Decide how many messages to ask for in each header FETCH.
+
+    After each batch we look at how long it took and how many bytes came
+    back per message, and work out the batch size that would just meet
+    the time and size targets. The size grows towards that gradually, at
+    most doubling each time, but shrinks straight away if a batch was too
+    slow or too big. It always stays between the minimum and maximum.
+    """
+
+    def __init__(
+        self, minimum: int = 10, maximum: int = 2000, target_seconds: float = 2.0,
+        max_bytes: int = 4_000_000, initial: int = 100,
+    ):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_seconds = target_seconds
+        self.max_bytes = max_bytes
+        self.size = max(minimum, min(maximum, initial))
+
+    @classmethod
+    def from_options(cls, options) -> "BatchSizer":
+        return cls(options.batch_min, options.batch_max, options.batch_seconds, options.batch_bytes)
+
+    def record(self, count: int, seconds: float, nbytes: int):
+        """
+        Adjust the size, given that `count` messages took `seconds` and
+        returned `nbytes` of headers.
+        """
+        if count == 0:
+            return
+        ideal = self.max_bytes * count / max(nbytes, 1)
+        if seconds > 0:
+            ideal = min(ideal, self.target_seconds * count / seconds)
+        if ideal > self.size:
+            size = min(self.size * 2, ideal)
+        else:
+            size = ideal
+        self.size = max(self.minimum, min(self.maximum, int(size)))
+
+
+def iter_fetch(
+    server: imaplib.IMAP4, uids: List[int], query: str, pipeline: int = 1,
+    sizer: Optional[BatchSizer] = None,
+) -> Iterator[Tuple[List[int], List[Tuple[int, bytes, Optional[bytes]]]]]:
+    """
+    Fetch the query items for the UIDs in batches, yielding each batch of UIDs
+    in turn with its response, as read_fetch() would return it.
+
+    Up to `pipeline` FETCH commands are kept outstanding on the connection,
+    so the server can be sending the next batches while we parse this one,
+    instead of us waiting a full round trip for each.
+
+    Each batch is as big as the sizer says at the time it's sent, as long
+    as its UID set fits within MAX_UID_SET_LENGTH, and the sizer is told
+    how each one went. The UIDs must be in order. With several batches in flight, a
+    batch is timed from when the one before it finished, so the time
+    spent waiting behind the others doesn't count against it.
+    """
+    sizer = sizer or BatchSizer()
+    in_flight: Deque[Tuple[List[int], bytes, float]] = deque()
+    last_done = time.monotonic()
+
+    def complete() -> Tuple[List[int], List[Tuple[int, bytes, Optional[bytes]]]]:
+        nonlocal last_done
+        batch, tag, sent = in_flight.popleft()
+        records = read_fetch(server, tag)
+        now = time.monotonic()
+        nbytes = sum(len(text) + len(literal or b"") for _, text, literal in records)
+        sizer.record(len(batch), now - max(sent, last_done), nbytes)
+        last_done = now
+        return batch, records
+
+    pos = 0
+    while pos < len(uids):
+        batch = uids[pos: pos + sizer.size]
+        # Widely spread UIDs can make a long command, which servers may refuse
+        batch = batch[:next(batch_uid_sets(batch))[1]]
+        pos += len(batch)
+        in_flight.append((batch, send_fetch(server, batch, query), time.monotonic()))
+        if len(in_flight) >= pipeline:
+            yield complete()
+    while in_flight:
+        yield complete()
+
+
+# The headers that -v shows for each duplicate
+MESSAGE_INFO_FIELDS = ["From", "To", "Cc", "Bcc", "Subject", "Date"]
+
+
+def get_message_info(parsed_message: Union[Message, HeaderBlock]) -> Tuple[str, ...]:
+    """
+    Just the decoded headers that print_message_info() shows, which is all
+    we need to keep of a duplicate until it's listed.
+    """
+    return tuple(str_header(parsed_message, name) for name in MESSAGE_INFO_FIELDS)
+
+
+def print_message_info(info: Tuple[str, ...]):
+    for name, value in zip(MESSAGE_INFO_FIELDS, info):
+        print(f"{name}: {value}")
+    print("")
+
+
+def get_select_code(server: imaplib.IMAP4, name: str) -> Optional[int]:
+    """
+    Return a numeric response code (e.g. UIDVALIDITY, UIDNEXT) sent by the
+    server while selecting the current mailbox, or None if it didn't send one.
+    """
+    value = server.untagged_responses.get(name)
+    if not value or not value[-1]:
+        return None
+    return int(value[-1])
+
+
+def get_key_mode(options, id_item: Optional[str] = None) -> str:
+    """
+    Describe how message IDs are being computed, so that cached IDs are only
+    reused by runs that would have computed the same values.
+    """
+    if id_item:
+        return f"server-id:{id_item}"
+    if options.content_bytes is not None:
+        with_id = "-with-id" if options.use_id_in_checksum else ""
+        return f"content{with_id}:{options.content_bytes}:{options.hash}"
+    if options.use_id_in_checksum:
+        return f"checksum-with-id:{options.hash}"
+    if options.use_checksum:
+        return f"checksum:{options.hash}"
+    return "message-id"
+
+
+def load_cache(path: str) -> Dict[str, Any]:
+    """
+    Load the message ID cache, or return an empty one if the file doesn't
+    exist yet. The cache maps each mailbox to its UIDVALIDITY and UIDNEXT at
+    the time of the last scan, plus the ID computed for each UID.
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_cache(path: str, cache: Dict[str, Any]):
+    """
+    Write the cache atomically, so an interrupted run can't leave it corrupt.
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wt") as f:
+        json.dump(cache, f)
+    os.replace(tmp_path, path)
+
+
+def get_cached_ids(
+    cache: Dict[str, Any], mbox: str, uidvalidity: Optional[int], key_mode: str
+) -> Dict[int, Optional[str]]:
+    """
+    Return the cached {uid: msg_id} entries for a mailbox, provided they were
+    recorded under the same UIDVALIDITY and with the same kind of ID.
+    UIDs below the recorded UIDNEXT never change their content, so only
+    messages that arrived since then need their headers fetched.
+    """
+    entry = cache.get(mbox)
+    if (
+        entry is None
+        or uidvalidity is None
+        or entry["uidvalidity"] != uidvalidity
+        or entry["key_mode"] != key_mode
+    ):
+        return {}
+    return {
+        int(uid): msg_id for uid, msg_id in entry["ids"].items()
+        if int(uid) < entry["uidnext"]
+    }
+
+
+def has_condstore(server: imaplib.IMAP4) -> bool:
+    """
+    Whether the server supports RFC 7162 CONDSTORE, which gives each mailbox
+    a HIGHESTMODSEQ that goes up whenever anything in it changes, and can
+    fetch just the messages changed since a given value.
+    """
+    return "CONDSTORE" in server.capabilities or "QRESYNC" in server.capabilities
+
+
+def uses_qresync(server: imaplib.IMAP4, options) -> bool:
+    """
+    Whether to enable RFC 7162 QRESYNC, which lets a SELECT report the
+    messages expunged since a given HIGHESTMODSEQ. It's only any use with
+    a cache to compare against.
+    """
+    return bool(options.cache) and "QRESYNC" in server.capabilities and "ENABLE" in server.capabilities
+
+
+def get_tracked_entry(
+    cache: Optional[Dict[str, Any]], mbox: str, key_mode: str
+) -> Optional[Dict[str, Any]]:
+    """
+    Return the cache entry for a mailbox if it recorded the mailbox's
+    HIGHESTMODSEQ and undeleted messages, so changes since then can be
+    fetched instead of searching again.
+    """
+    entry = cache.get(mbox) if cache is not None else None
+    if entry is None or entry.get("highestmodseq") is None or entry["key_mode"] != key_mode:
+        return None
+    return entry
+
+
+def get_changed_msgnums(
+    server: imaplib.IMAP4, entry: Dict[str, Any], exists: int, highestmodseq: int, qresync: bool,
+    vanished: List[bytes], changes: List[Any],
+) -> Optional[List[int]]:
+    """
+    Work out the undeleted messages in the selected mailbox from those in
+    its cache entry, and the changes since the entry's HIGHESTMODSEQ.
+
+    With QRESYNC, the SELECT has already told us about them: VANISHED for
+    the expunged UIDs, and FETCH for messages whose flags changed or which
+    are new. Otherwise we fetch the flags that changed, but can't see
+    expunges, so we check the number of messages adds up instead.
+    Returns None if the changes can't be worked out, in which case the
+    mailbox needs searching as usual.
+    """
+    undeleted = set(expand_uid_set(entry["undeleted"]))
+    new = 0
+    if highestmodseq != entry["highestmodseq"]:
+        if not qresync:
+            changes = check_response(
+                server.uid("FETCH", "1:*", "(FLAGS)", "(CHANGEDSINCE %d)" % entry["highestmodseq"])
+            )
+        for data in vanished:
+            undeleted.difference_update(expand_uid_set(data.decode().replace("(EARLIER)", "").strip()))
+        for uid, text, _ in parse_fetch_response(changes):
+            flags = fetch_flags_pattern.search(text)
+            if flags is None:
+                return None
+            if uid >= entry["uidnext"]:
+                new += 1
+            if b"\\Deleted" in flags.group(1).split():
+                undeleted.discard(uid)
+            else:
+                undeleted.add(uid)
+    # An expunge needn't change HIGHESTMODSEQ, so without QRESYNC this is
+    # checked even when nothing else has changed
+    if not qresync and entry["exists"] + new != exists:
+        return None  # some messages were expunged
+    if len(undeleted) > exists:
+        return None
+    return sorted(undeleted)
+
+
+class Checkpoint:
+    """
+    The --checkpoint journal: a file of JSON lines recording the IDs from
+    each batch of headers as it's read, and each batch of messages once
+    it's been stored or copied, so that an interrupted run can be resumed.
+
+    On resuming, IDs from the journal are used like cached ones, and the
+    messages already acted on are skipped. Everything is recorded against
+    the mailbox's UIDVALIDITY, so nothing is reused if that changes.
+    """
+
+    def __init__(self, path: str, resume: bool = False):
+        self.path = path
+        self.lock = threading.Lock()
+        # {mbox: {"uidvalidity": ..., "key_mode": ..., "ids": {uid: msg_id}}}
+        self.scanned: Dict[str, Dict[str, Any]] = {}
+        # {mbox: {"uidvalidity": ..., "uids": set of UIDs acted on}}
+        self.stored: Dict[str, Dict[str, Any]] = {}
+        if resume and os.path.exists(path):
+            self.load()
+        self.file = open(path, "a" if resume else "w")
+
+    def load(self):
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break  # the run stopped part way through writing this
+                mbox, uidvalidity = entry["mbox"], entry["uidvalidity"]
+                if entry["type"] == "ids":
+                    scanned = self.scanned.get(mbox)
+                    if scanned is None or (scanned["uidvalidity"], scanned["key_mode"]) != (uidvalidity, entry["key_mode"]):
+                        scanned = self.scanned[mbox] = {"uidvalidity": uidvalidity, "key_mode": entry["key_mode"], "ids": {}}
+                    scanned["ids"].update((uid, msg_id) for uid, msg_id in entry["ids"])
+                elif entry["type"] == "stored":
+                    stored = self.stored.get(mbox)
+                    if stored is None or stored["uidvalidity"] != uidvalidity:
+                        stored = self.stored[mbox] = {"uidvalidity": uidvalidity, "uids": set()}
+                    stored["uids"].update(expand_uid_set(entry["uids"]))
+
+    def write(self, entry: Dict[str, Any]):
+        with self.lock:
+            self.file.write(json.dumps(entry) + "\n")
+            self.file.flush()
+
+    def get_ids(self, mbox: str, uidvalidity: Optional[int], key_mode: str) -> Dict[int, Optional[str]]:
+        """
+        Return the {uid: msg_id} entries recorded for the mailbox by an
+        earlier run, provided they're still valid.
+        """
+        scanned = self.scanned.get(mbox)
+        if scanned is None or uidvalidity is None or (scanned["uidvalidity"], scanned["key_mode"]) != (uidvalidity, key_mode):
+            return {}
+        return dict(scanned["ids"])
+
+    def record_ids(self, mbox: str, uidvalidity: Optional[int], key_mode: str, ids: List[Tuple[int, Optional[str]]]):
+        if uidvalidity is not None and ids:
+            self.write({"type": "ids", "mbox": mbox, "uidvalidity": uidvalidity, "key_mode": key_mode, "ids": ids})
+
+    def get_stored(self, mbox: str, uidvalidity: Optional[int]) -> set:
+        """
+        Return the UIDs in the mailbox that an earlier run already acted on.
+        """
+        stored = self.stored.get(mbox)
+        if stored is None or uidvalidity is None or stored["uidvalidity"] != uidvalidity:
+            return set()
+        return stored["uids"]
+
+    def record_stored(self, mbox: str, uidvalidity: Optional[int], uid_set: str):
+        if uidvalidity is not None:
+            self.write({"type": "stored", "mbox": mbox, "uidvalidity": uidvalidity, "uids": uid_set})
+
+    def close(self):
+        self.file.close()
+
+    def finish(self):
+        """
+        The run completed, so there's nothing to resume.
+        """
+        self.close()
+        os.remove(self.path)
+
+
+def add_quotes(mbox: str) -> str:
+    if " " in mbox and (mbox[0] != '"' or mbox[-1] != '"'):
+        mbox = '"' + mbox + '"'
+    return mbox
+
+
+class MetricsPhase:
+    """
+    A timed stretch of one phase of the work, such as searching or
+    fetching, in a particular mailbox. Used as a context manager.
+    """
+
+    def __init__(self, metrics: "Metrics", name: str, mbox: str, messages: int):
+        self.metrics = metrics
+        self.key = (mbox, name)
+        self.messages = messages
+
+    def __enter__(self):
+        self.metrics.stack().append(self.key)
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.started
+        self.metrics.stack().pop()
+        self.metrics.add(self.key[1], self.key[0], seconds, self.messages)
+
+
+class Metrics:
+    """
+    Wall time, round trips, bytes sent and received, and message counts,
+    for each phase of the work in each mailbox, as reported by --metrics.
+
+    Phases don't overlap, so their times add up. Network traffic is counted
+    by connections passed to instrument(), and goes to whichever phase is in
+    progress on the thread that caused it.
+    When disabled, phases and instrumentation cost next to nothing.
+    """
+
+    FIELDS = ("seconds", "calls", "messages", "round_trips", "bytes_out", "bytes_in")
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.records: Dict[Tuple[str, str], Dict[str, float]] = {}
+        self.duplicates: Dict[str, int] = {}
+        # Messages looked at in each mailbox, which a retry replaces rather than adds to
+        self.scanned: Dict[str, int] = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.started = time.time()
+        self.clock = time.perf_counter()
+
+    def reset(self):
+        """ Start again from nothing, e.g. once what's been recorded has been written out. """
+        with self.lock:
+            self.records = {}
+            self.duplicates = {}
+            self.scanned = {}
+        self.started = time.time()
+        self.clock = time.perf_counter()
+
+    def stack(self) -> List[Tuple[str, str]]:
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    def record(self, name: str, mbox: str) -> Dict[str, float]:
+        # Call with the lock held
+        record = self.records.get((mbox, name))
+        if record is None:
+            record = self.records[(mbox, name)] = dict.fromkeys(self.FIELDS, 0)
+        return record
+
+    def phase(self, name: str, mbox: str = "", messages: int = 0) -> Any:
+        if not self.enabled:
+            return nullcontext()
+        return MetricsPhase(self, name, mbox, messages)
+
+    def add(self, name: str, mbox: str = "", seconds: float = 0.0, messages: int = 0, calls: int = 1):
+        """ Record time spent in a phase that was measured by the caller. """
+        if not self.enabled:
+            return
+        with self.lock:
+            record = self.record(name, mbox)
+            record["seconds"] += seconds
+            record["calls"] += calls
+            record["messages"] += messages
+
+    def count(self, field: str, amount: int):
+        stack = self.stack()
+        mbox, name = stack[-1] if stack else ("", "other")
+        with self.lock:
+            self.record(name, mbox)[field] += amount
+
+    def timed(self, iterable: Iterable, name: str, mbox: str = "") -> Iterator:
+        """
+        Yield from the iterable, counting the time spent waiting for each
+        item (but not in the caller's hands) as the named phase.
+        """
+        if not self.enabled:
+            yield from iterable
+            return
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name, mbox):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def instrument(self, server: imaplib.IMAP4):
+        """
+        Count the commands and bytes that go over this connection. Once
+        start_compression() has been called, it counts the bytes instead.
+        """
+        if not self.enabled:
+            return
+        send, read, readline, command = server.send, server.read, server.readline, server._command
+
+        def counted_send(data):
+            if not getattr(server, "compressed", False):
+                self.count("bytes_out", len(data))
+            return send(data)
+
+        def counted_read(size):
+            data = read(size)
+            if not getattr(server, "compressed", False):
+                self.count("bytes_in", len(data))
+            return data
+
+        def counted_readline():
+            line = readline()
+            if not getattr(server, "compressed", False):
+                self.count("bytes_in", len(line))
+            return line
+
+        def counted_command(*args, **kwargs):
+            self.count("round_trips", 1)
+            return command(*args, **kwargs)
+
+        server.send, server.read, server.readline = counted_send, counted_read, counted_readline
+        server._command = counted_command
+
+    def write(self, path: str, options, messages: int):
+        """
+        Append a line for each mailbox and phase to the file, then one for
+        each mailbox, then one for the whole run, all tagged with the server
+        and the time the run started so they can be grouped again.
+        """
+        seconds = time.perf_counter() - self.clock
+        common = {
+            "run": datetime.fromtimestamp(self.started, timezone.utc).isoformat(timespec="seconds"),
+            "server": options.server or options.process,
+        }
+        totals = dict.fromkeys(self.FIELDS, 0)
+        mailboxes: Dict[str, Dict[str, float]] = {}
+        lines = []
+        with self.lock:
+            for (mbox, name), record in sorted(self.records.items()):
+                lines.append({**common, "type": "phase", "mailbox": mbox, "phase": name,
+                              **record, "seconds": round(record["seconds"], 6)})
+                for field in ("round_trips", "bytes_out", "bytes_in"):
+                    totals[field] += record[field]
+                if mbox:
+                    summary = mailboxes.setdefault(mbox, dict.fromkeys(self.FIELDS, 0))
+                    for field in self.FIELDS:
+                        summary[field] += record[field]
+        for mbox, summary in mailboxes.items():
+            lines.append({**common, "type": "mailbox", "mailbox": mbox,
+                          "seconds": round(summary["seconds"], 6),
+                          "messages": self.records.get((mbox, "index"), {}).get("messages", 0),
+                          "duplicates": self.duplicates.get(mbox, 0),
+                          "round_trips": summary["round_trips"],
+                          "bytes_out": summary["bytes_out"], "bytes_in": summary["bytes_in"]})
+        lines.append({**common, "type": "run", "seconds": round(seconds, 6),
+                      "mailboxes": len(mailboxes), "messages": messages,
+                      "duplicates": sum(self.duplicates.values()),
+                      "messages_per_sec": round(messages / seconds, 1) if seconds else None,
+                      "round_trips": totals["round_trips"],
+                      "bytes_out": totals["bytes_out"], "bytes_in": totals["bytes_in"],
+                      "key_mode": get_key_mode(options), "jobs": options.jobs,
+                      "pipeline": options.pipeline, "dry_run": options.dry_run})
+        with open(path, "a") as f:
+            for line in lines:
+                f.write(json.dumps(line) + "\n")
+
+
+# imaplib doesn't know the RFC 4978 COMPRESS command
+imaplib.Commands.setdefault("COMPRESS", ("AUTH", "SELECTED"))
+
+
+class DeflateSocket:
+    """
+    Stands in for imaplib's socket once COMPRESS=DEFLATE is in effect,
+    compressing everything sent. Each command is flushed as it's sent, so
+    the server can decompress it straight away. If given, count is called
+    with the number of bytes that actually go over the wire.
+    """
+
+    def __init__(self, sock: socket.socket, count: Optional[Callable[[int], None]] = None):
+        self.sock = sock
+        self.count = count
+        self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+
+    def sendall(self, data: bytes):
+        data = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        if self.count is not None:
+            self.count(len(data))
+        self.sock.sendall(data)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.sock, name)
+
+
+class DeflateReader(io.RawIOBase):
+    """
+    Decompresses what the server sends, for imaplib to read through a
+    BufferedReader just as it reads the socket's own file. If given, count
+    is called with the number of compressed bytes read.
+    """
+
+    def __init__(self, file: Any, count: Optional[Callable[[int], None]] = None):
+        self.file = file
+        self.count = count
+        self.decompressor = zlib.decompressobj(-15)
+        self.pending = b""
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer: Any) -> int:
+        while not self.pending:
+            data = self.file.read1(65536)
+            if not data:
+                return 0
+            if self.count is not None:
+                self.count(len(data))
+            self.pending = self.decompressor.decompress(data)
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+    def close(self):
+        self.file.close()
+        super().close()
+
+
+def start_compression(server: imaplib.IMAP4, metrics: Optional[Metrics] = None):
+    """
+    Turn on RFC 4978 COMPRESS=DEFLATE, after which everything in both
+    directions is compressed. Headers are mostly repetitive text, so this
+    cuts the data transferred several times over.
+
+    From then on, the metrics count the compressed bytes, which is what
+    actually goes over the wire, rather than what imaplib sends and reads.
+    """
+    check_response(server._simple_command("COMPRESS", "DEFLATE"))
+    count_out = count_in = None
+    if metrics is not None and metrics.enabled:
+        count_out = partial(metrics.count, "bytes_out")
+        count_in = partial(metrics.count, "bytes_in")
+    server.sock = DeflateSocket(server.sock, count_out)
+    server.file = io.BufferedReader(DeflateReader(server.file, count_in))
+    server.compressed = True
+
+
+def connect(options, metrics: Optional[Metrics] = None) -> imaplib.IMAP4:
+    """
+    Open a connection to the server and log in, as specified by the options.
+    Raises ConnectionFailed if it can't.
+    """
     serverclass: Type[Any]
     if options.process:
         serverclass = imaplib.IMAP4_stream
@@ -521,7 +2249,10 @@ def process(options, mboxes: List[str]):
             "\nFailed to connect to server. Might be host, port or SSL settings?\n"
         )
         sys.stderr.write("%s\n\n" % e)
-        sys.exit(1)
+        raise ConnectionFailed(e)
+
+    if metrics is not None:
+        metrics.instrument(server)
 
     #  server.debug = 4  # If you want to see what's going on
 
@@ -529,7 +2260,7 @@ def process(options, mboxes: List[str]):
         server.starttls()
     elif options.starttls:
         sys.stderr.write("\nError: Server did not offer TLS\n")
-        sys.exit(1)
+        raise ConnectionFailed("Server did not offer TLS")
     elif not options.ssl:
         sys.stderr.write("\nWarning: Unencrypted connection\n")
 
@@ -548,7 +2279,754 @@ def process(options, mboxes: List[str]):
     except Exception as e:
         print(e)
         sys.stderr.write("\nError: Login failed\n")
-        sys.exit(1)
+        raise ConnectionFailed(e)
+
+    # There's nothing to gain by compressing a pipe to a local process
+    if "COMPRESS=DEFLATE" in server.capabilities and not options.no_compress and not options.process:
+        start_compression(server, metrics)
+
+    # Whether to use it is only decided here, so remember whether we did, for
+    # runs made with other options on the same connection
+    server.qresync_enabled = False
+    if uses_qresync(server, options):
+        check_response(server.enable("QRESYNC"))
+        server.qresync_enabled = True
+
+    return server
+
+
+def get_size_keys(server: imaplib.IMAP4, options, mbox: str) -> Dict[int, str]:
+    """
+    Return {uid: key} for the undeleted messages in a mailbox, where the key
+    is made from whichever of its size and received date the options say
+    duplicates must share. These are only a few bytes per message, even
+    for a large mailbox.
+    """
+    msgs = check_response(server.select(mailbox=mbox, readonly=True))[0]
+    if int(msgs) == 0:
+        return {}
+    items = ["FLAGS"]
+    if options.same_size:
+        items.append("RFC822.SIZE")
+    if options.same_date:
+        items.append("INTERNALDATE")
+    keys = {}
+    for uid, text, _ in parse_fetch_response(check_response(server.uid("FETCH", "1:*", "(%s)" % " ".join(items)))):
+        flags = fetch_flags_pattern.search(text)
+        if flags is not None and b"\\Deleted" in flags.group(1).split():
+            continue
+        parts = []
+        if options.same_size:
+            m = fetch_size_pattern.search(text)
+            parts.append(f"size:{m.group(1).decode() if m else '?'}")
+        if options.same_date:
+            m = fetch_date_pattern.search(text)
+            parts.append(f"date:{m.group(1).decode() if m else '?'}")
+        keys[uid] = "/".join(parts)
+    return keys
+
+
+def find_size_matches(
+    server: imaplib.IMAP4, options, mboxes: List[str], metrics: Optional[Metrics] = None
+) -> Dict[str, Dict[int, str]]:
+    """
+    Before reading any headers, fetch the size (and/or date) of every
+    message in all the mailboxes, and return {mbox: {uid: key}} for just
+    the messages whose key is shared with another message somewhere. The
+    rest can't have an exact duplicate, so their headers aren't needed.
+    """
+    metrics = metrics or Metrics(enabled=False)
+    keys = {}
+    for mbox in mboxes:
+        with metrics.phase("size", mbox):
+            keys[mbox] = get_size_keys(server, options, mbox)
+    counts: Dict[str, int] = {}
+    for mbox_keys in keys.values():
+        for key in mbox_keys.values():
+            counts[key] = counts.get(key, 0) + 1
+    matches = {
+        mbox: {uid: key for uid, key in mbox_keys.items() if counts[key] > 1}
+        for mbox, mbox_keys in keys.items()
+    }
+    total = sum(len(mbox_keys) for mbox_keys in keys.values())
+    matched = sum(len(mbox_matches) for mbox_matches in matches.values())
+    what = " and ".join(name for name, used in (("size", options.same_size), ("date", options.same_date)) if used)
+    print(f"{matched} of {total} message(s) share their {what} with another, so only those will be read")
+    return matches
+
+
+class MailboxScan(NamedTuple):
+    """
+    What we found in one mailbox: the ID of each undeleted message, in UID
+    order, along with the headers -v and -S show (from get_message_info())
+    if we'll need them later, and the entry to record for the mailbox in
+    the --cache file.
+    """
+    mbox: str
+    messages: List[Tuple[int, Optional[str], Optional[Tuple[str, ...]]]]
+    cache_entry: Optional[Dict[str, Any]]
+    deleted: int
+    uidvalidity: Optional[int]
+    # Set for local Maildir and mbox sources
+    local: Optional["LocalMailbox"] = None
+
+
+def scan_mailbox(
+    server: imaplib.IMAP4, options, mbox: str, cache: Optional[Dict[str, Any]], readonly: bool,
+    metrics: Optional[Metrics] = None, checkpoint: Optional[Checkpoint] = None,
+    size_keys: Optional[Dict[int, str]] = None, msg_list: Optional[MessageListWriter] = None,
+) -> MailboxScan:
+    """
+    Select the mailbox and work out the ID of each of its undeleted messages,
+    fetching headers for any we don't already have in the cache. If msg_list
+    is given, each batch of messages read is added to it as we go.
+
+    If size_keys is given, as {uid: key} from find_size_matches(), only
+    those messages are read, and their IDs are prefixed with the key. The
+    others get no ID, so they're never counted as duplicates.
+    """
+    metrics = metrics or Metrics(enabled=False)
+
+    # Only hang on to the headers if something is going to display them,
+    # and then just the ones it shows.
+    keep_headers = options.verbose or options.show
+    parser = BytesParser()
+
+    # Use the server's own IDs if asked to and it has them, in which case we
+    # only need headers for display.
+    id_item = get_server_id_item(server) if options.server_ids else None
+    if options.server_ids and id_item is None:
+        print(f"Server doesn't provide message IDs, so using headers for {mbox}")
+    key_mode = get_key_mode(options, id_item)
+    header_fields = get_header_fields(options, for_key=id_item is None)
+    wanted = [field.lower() for field in header_fields]
+    query = get_fetch_query(header_fields, id_item, options.content_bytes)
+
+    # With CONDSTORE, the cache also records what the mailbox looked like,
+    # so if little has changed we don't have to search it again.
+    condstore = cache is not None and options.sent_before is None and has_condstore(server)
+    qresync = condstore and getattr(server, "qresync_enabled", False)
+    tracked = get_tracked_entry(cache, mbox, key_mode) if condstore else None
+    select_name = mbox
+    if qresync and tracked is not None:
+        select_name = f'{mbox} (QRESYNC ({tracked["uidvalidity"]} {tracked["highestmodseq"]}))'
+    elif condstore and not qresync:
+        select_name = f"{mbox} (CONDSTORE)"
+
+    # Select the mailbox
+    with metrics.phase("select", mbox):
+        msgs = check_response(server.select(mailbox=select_name, readonly=readonly))[0]
+    print("There are %d messages in %s." % (int(msgs), mbox))
+    uidvalidity = get_select_code(server, "UIDVALIDITY")
+    uidnext = get_select_code(server, "UIDNEXT")
+    highestmodseq = get_select_code(server, "HIGHESTMODSEQ") if condstore else None
+    # Changes reported by a QRESYNC select, which mustn't be mixed up with our own FETCHes
+    vanished = server.untagged_responses.pop("VANISHED", [])
+    changes = server.untagged_responses.pop("FETCH", [])
+
+    with metrics.phase("search", mbox):
+        msgnums = None
+        if tracked is not None and highestmodseq is not None and tracked["uidvalidity"] == uidvalidity:
+            msgnums = get_changed_msgnums(server, tracked, int(msgs), highestmodseq, qresync, vanished, changes)
+            if msgnums is not None and options.verbose:
+                print(f"Found the changes in {mbox} since the last run")
+
+        # Get a list of the messages that aren't deleted.
+        # That's what we'll actually use.
+        if msgnums is None:
+            msgnums = get_undeleted_msgnums(server, options.sent_before)
+
+        # Check how many messages are already marked 'deleted'...
+        # which is just the rest, unless we're only looking at older ones.
+        if options.sent_before is None:
+            numdeleted = max(int(msgs) - len(msgnums), 0)
+        else:
+            numdeleted = count_matching_msgs(server, "DELETED", options.sent_before)
+    print(f'{numdeleted or "No"} message(s) currently marked as deleted in {mbox}')
+    print(f"{len(msgnums)} others in {mbox}")
+
+    # IDs we already know from an earlier run don't need fetching again,
+    # unless we need the other headers for the message list.
+    cached_ids: Dict[int, Optional[str]] = {}
+    if cache is not None and not options.save_msg_list:
+        cached_ids = get_cached_ids(cache, mbox, uidvalidity, key_mode)
+        if cached_ids:
+            print(f"{sum(1 for n in msgnums if n in cached_ids)} message ID(s) in {mbox} found in cache")
+    # Likewise for the ones an interrupted run got through
+    if checkpoint is not None and not options.save_msg_list:
+        resumed_ids = checkpoint.get_ids(mbox, uidvalidity, key_mode)
+        if resumed_ids:
+            print(f"{sum(1 for n in msgnums if n in resumed_ids)} message ID(s) in {mbox} found in checkpoint")
+            cached_ids.update(resumed_ids)
+
+    messages: List[Tuple[int, Optional[str], Optional[Tuple[str, ...]]]] = []
+
+    sizer = BatchSizer.from_options(options)
+    if options.verbose:
+        print("Reading the others... (in batches of %d to %d)" % (sizer.minimum, sizer.maximum))
+
+    to_fetch = [mnum for mnum in msgnums if mnum not in cached_ids]
+    if size_keys is not None:
+        to_fetch = [mnum for mnum in to_fetch if mnum in size_keys]
+        print(f"{len(msgnums) - sum(1 for mnum in msgnums if mnum in size_keys)} message(s) in {mbox} "
+              "can't be duplicates, so won't be read")
+    fetches = metrics.timed(iter_fetch(server, to_fetch, query, options.pipeline, sizer), "fetch", mbox)
+    parse_seconds = key_seconds = 0.0
+
+    # Work through msgnums in order, taking IDs from the cache where we can,
+    # and otherwise from each batch of headers as it arrives.
+    i = 0
+    for batch, records in chain(fetches, [([], [])]):
+        if options.verbose and batch:
+            print("Batch of %d starting at item %d in %s" % (len(batch), i, mbox))
+
+        fetched = {uid: (text, literal) for uid, text, literal in records}
+        last = batch[-1] if batch else None
+        batch_ids: List[Tuple[int, Optional[str]]] = []
+        rows: List[List[str]] = []
+
+        # and parse them.
+        while i < len(msgnums) and (last is None or msgnums[i] <= last):
+            mnum = msgnums[i]
+            i += 1
+            if size_keys is not None and mnum not in size_keys:
+                messages.append((mnum, None, None))
+            elif mnum in cached_ids:
+                messages.append((mnum, cached_ids[mnum], None))
+            elif mnum in fetched:
+                text, hinfo = fetched[mnum]
+                started = time.perf_counter()
+                content: List[bytes] = []
+                if options.content_bytes is not None:
+                    parts = split_fetch_literal(text, hinfo)
+                    hinfo = next((data for name, data in parts.items() if name.startswith(b"BODY[HEADER")), None)
+                    content = get_content(text, parts)
+                # Parse the header info into a Message object
+                mp = parse_headers(hinfo, wanted, parser) if hinfo is not None else None
+                parsed = time.perf_counter()
+                if id_item:
+                    m = server_id_patterns[id_item].search(text)
+                    msg_id = f"{id_item}:{m.group(1).decode()}" if m else None
+                elif mp is None:
+                    # The server sent the headers as "" or NIL rather than a literal
+                    print(f"Message {mnum} in {mbox} came back with no headers, so it will be skipped.")
+                    msg_id = None
+                else:
+                    # Record the message-ID header (or generate one from other headers)
+                    msg_id = get_message_id(
+                        mp, options.use_checksum, options.use_id_in_checksum, options.hash, content
+                    )
+                parse_seconds += parsed - started
+                key_seconds += time.perf_counter() - parsed
+                info = get_message_info(mp) if keep_headers and mp is not None else None
+                messages.append((mnum, msg_id, info))
+                batch_ids.append((mnum, msg_id))
+                if msg_list is not None and mp is not None:
+                    rows.append(get_message_list_row(mp))
+            # Otherwise it was expunged by another client since we searched
+
+        if rows:
+            msg_list.add(rows)
+        if checkpoint is not None:
+            checkpoint.record_ids(mbox, uidvalidity, key_mode, batch_ids)
+
+        if batch or not to_fetch:
+            print(f"{i} message(s) in {mbox} processed")
+
+    fetched_count = sum(
+        1 for mnum, _, _ in messages
+        if mnum not in cached_ids and (size_keys is None or mnum in size_keys)
+    )
+    metrics.add("fetch", mbox, messages=fetched_count, calls=0)
+    metrics.add("parse", mbox, parse_seconds, fetched_count)
+    metrics.add("key", mbox, key_seconds, fetched_count)
+
+    # Messages that weren't read keep whatever ID the cache had for them
+    unread = set() if size_keys is None else {mnum for mnum in msgnums if mnum not in size_keys}
+
+    cache_entry = None
+    if cache is not None and uidvalidity is not None:
+        scanned_ids = {mnum: msg_id for mnum, msg_id, _ in messages if mnum not in unread}
+        # When only some messages were searched or read, keep what we knew about the rest.
+        if options.sent_before or unread:
+            scanned_ids = {**cached_ids, **scanned_ids}
+        cache_entry = {
+            "uidvalidity": uidvalidity,
+            "uidnext": uidnext or max(msgnums, default=0) + 1,
+            "key_mode": key_mode,
+            "ids": {str(uid): msg_id for uid, msg_id in scanned_ids.items()},
+        }
+        if highestmodseq is not None:
+            cache_entry.update({
+                "highestmodseq": highestmodseq,
+                "exists": int(msgs),
+                "undeleted": format_uid_set(msgnums),
+            })
+
+    if size_keys is not None:
+        # Only messages with the same size (or date) and ID are the same
+        messages = [
+            (mnum, f"{size_keys[mnum]}/{msg_id}" if msg_id else None, info)
+            for mnum, msg_id, info in messages
+        ]
+
+    return MailboxScan(mbox, messages, cache_entry, numdeleted, uidvalidity)
+
+
+def scan_mailboxes_in_parallel(
+    options, mboxes: List[str], cache: Optional[Dict[str, Any]], metrics: Optional[Metrics] = None,
+    checkpoint: Optional[Checkpoint] = None, size_matches: Optional[Dict[str, Dict[int, str]]] = None,
+    msg_list: Optional[MessageListWriter] = None,
+) -> Iterator[MailboxScan]:
+    """
+    Scan the mailboxes using a pool of up to options.jobs extra connections,
+    yielding the results in the original mailbox order, however they finish.
+    The scans only read from the server, so mailboxes are opened read-only.
+    """
+    metrics = metrics or Metrics(enabled=False)
+    local = threading.local()
+    connections: List[imaplib.IMAP4] = []
+    lock = threading.Lock()
+
+    def scan(mbox: str) -> MailboxScan:
+        server = getattr(local, "server", None)
+        if server is None:
+            with metrics.phase("connect"):
+                server = local.server = connect(options, metrics)
+            with lock:
+                connections.append(server)
+        return scan_mailbox(
+            server, options, mbox, cache, readonly=True, metrics=metrics, checkpoint=checkpoint,
+            size_keys=size_matches[mbox] if size_matches is not None else None, msg_list=msg_list,
+        )
+
+    pool = ThreadPoolExecutor(max_workers=options.jobs)
+    # Copying the context keeps the output with the account, under run_accounts()
+    futures = [pool.submit(contextvars.copy_context().run, scan, mbox) for mbox in mboxes]
+    try:
+        for future in futures:
+            yield future.result()
+    finally:
+        for future in futures:
+            future.cancel()
+        pool.shutdown(wait=True)
+        for server in connections:
+            try:
+                with metrics.phase("logout"):
+                    server.logout()
+            except (imaplib.IMAP4.error, OSError):
+                pass
+
+
+def local_mailbox_kind(path: str) -> Optional[str]:
+    """
+    Return 'maildir' or 'mbox' for a local mailbox, or None if it's neither.
+    """
+    if os.path.isdir(path):
+        if os.path.isdir(os.path.join(path, "cur")) and os.path.isdir(os.path.join(path, "new")):
+            return "maildir"
+        return None
+    if os.path.isfile(path):
+        return "mbox"
+    return None
+
+
+# The blank line at the end of the headers
+header_end_pattern = re.compile(rb"\r?\n\r?\n")
+
+
+def read_maildir_headers(path: str, chunk_size: int = 16384) -> bytes:
+    """
+    Read just the header block of a message file, a chunk at a time.
+    """
+    data = b""
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            # Look again from just before the new chunk in case the blank line spans the join
+            m = header_end_pattern.search(data + chunk, max(len(data) - 3, 0))
+            data += chunk
+            if m is not None:
+                return data[:m.end()]
+            if not chunk:
+                return data
+
+
+def maildir_flags(name: str) -> str:
+    """
+    The flags in the info part of a Maildir file name, e.g. 'ST' in '1234.x:2,ST'.
+    """
+    _, sep, flags = name.partition(":2,")
+    return flags if sep else ""
+
+
+def trash_maildir_message(path: str) -> str:
+    """
+    Add the Maildir 'T' (trashed) flag to a message, which is what an IMAP
+    server shows as \\Deleted, moving it into cur/ if it was in new/.
+    Returns its new path.
+    """
+    folder, name = os.path.split(path)
+    base = name.partition(":2,")[0]
+    flags = "".join(sorted(set(maildir_flags(name)) | {"T"}))
+    new_path = os.path.join(os.path.dirname(folder), "cur", f"{base}:2,{flags}")
+    os.rename(path, new_path)
+    return new_path
+
+
+class LocalMailbox(NamedTuple):
+    """
+    Where the messages in a local source are: a list of file paths for a
+    Maildir, in the order we numbered them, or nothing for an mbox file,
+    which we only read.
+    """
+    path: str
+    kind: str
+    files: Optional[List[str]]
+
+
+def iter_mbox_headers(path: str) -> Iterator[bytes]:
+    """
+    Yield the header block of each message in an mbox file. The file is
+    memory-mapped and searched for the headers' ends and the 'From ' lines
+    between messages, so the bodies are never read into Python.
+    """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            # Like Python's mailbox module, a message starts at any line beginning 'From '
+            start = 0 if data[:5] == b"From " else data.find(b"\nFrom ") + 1
+            if start == 0 and data[:5] != b"From ":
+                return
+            while True:
+                headers = data.find(b"\n", start) + 1
+                if headers == 0:
+                    return
+                m = header_end_pattern.search(data, headers)
+                end = m.end() if m is not None else len(data)
+                yield data[headers:end]
+                start = data.find(b"\nFrom ", end - 1) + 1
+                if start == 0:
+                    return
+
+
+def scan_local_source(
+    options, path: str, metrics: Optional[Metrics] = None, msg_list: Optional[MessageListWriter] = None
+) -> MailboxScan:
+    """
+    Work out the ID of each message in a local Maildir or mbox, just as
+    scan_mailbox() does for an IMAP mailbox, reading only the headers.
+    Messages are numbered from 1 in the order they're found, which for a
+    Maildir is the order of their file names, which begin with the time
+    they were delivered. Maildir messages already flagged as trashed are
+    treated as deleted.
+    """
+    metrics = metrics or Metrics(enabled=False)
+    keep_headers = options.verbose or options.show
+    parser = BytesParser()
+    wanted = [field.lower() for field in get_header_fields(options)]
+    kind = local_mailbox_kind(path)
+
+    files: Optional[List[str]] = None
+    numdeleted = 0
+    with metrics.phase("list", path):
+        if kind == "maildir":
+            names = []
+            for sub in ("cur", "new"):
+                for name in os.listdir(os.path.join(path, sub)):
+                    if name.startswith("."):
+                        continue
+                    if "T" in maildir_flags(name):
+                        numdeleted += 1
+                    else:
+                        names.append((name, os.path.join(path, sub, name)))
+            files = [file_path for _, file_path in sorted(names)]
+            blocks: Iterable[bytes] = (read_maildir_headers(file_path) for file_path in files)
+        else:
+            blocks = iter_mbox_headers(path)
+
+    # The headers are read one message at a time as we go, so we only know
+    # how many there are at the end.
+    messages: List[Tuple[int, Optional[str], Optional[Tuple[str, ...]]]] = []
+    read_seconds = parse_seconds = key_seconds = 0.0
+    started = time.perf_counter()
+    for mnum, hinfo in enumerate(blocks, 1):
+        read = time.perf_counter()
+        read_seconds += read - started
+        started = read
+        mp = parse_headers(hinfo, wanted, parser)
+        parsed = time.perf_counter()
+        msg_id = get_message_id(mp, options.use_checksum, options.use_id_in_checksum, options.hash)
+        parse_seconds += parsed - started
+        key_seconds += time.perf_counter() - parsed
+        messages.append((mnum, msg_id, get_message_info(mp) if keep_headers else None))
+        if msg_list is not None:
+            msg_list.add([get_message_list_row(mp)])
+        started = time.perf_counter()
+    read_seconds += time.perf_counter() - started
+    metrics.add("read", path, read_seconds, len(messages))
+    metrics.add("parse", path, parse_seconds, len(messages))
+    metrics.add("key", path, key_seconds, len(messages))
+    print("There are %d messages in %s." % (len(messages) + numdeleted, path))
+    print(f'{numdeleted or "No"} message(s) currently marked as deleted in {path}')
+    print(f"{len(messages)} others in {path}")
+    print(f"{len(messages)} message(s) in {path} processed")
+
+    return MailboxScan(path, messages, None, numdeleted, None, LocalMailbox(path, kind, files))
+
+
+def act_on_local_duplicates(options, scan: MailboxScan, msgs_to_delete: List[int], msg_map: Dict[int, Any]):
+    """
+    Deal with the duplicates found in a local source: flag them as trashed
+    if it's a Maildir, or just say what they are.
+    """
+    local = scan.local
+    if options.verbose:
+        print("These are the duplicate messages: ")
+        for mnum in msgs_to_delete:
+            if mnum in msg_map:
+                print_message_info(msg_map[mnum])
+
+    if options.dry_run or local.files is None:
+        print(
+            "If you had NOT selected the 'dry-run' option,\n"
+            "  %i messages would now be marked as deleted." % len(msgs_to_delete)
+        )
+        return
+
+    print("Marking %i messages as deleted..." % len(msgs_to_delete))
+    for mnum in msgs_to_delete:
+        new_path = trash_maildir_message(local.files[mnum - 1])
+        if options.verbose:
+            print(f"Flagged {new_path}")
+    print(
+        "There are now %s messages marked as deleted and %s others in %s."
+        % (scan.deleted + len(msgs_to_delete), len(scan.messages) - len(msgs_to_delete), scan.mbox)
+    )
+
+
+# Where print() and sys.stderr.write() go for the account being handled in
+# this context, while run_accounts() has replaced sys.stdout and sys.stderr
+account_output: contextvars.ContextVar[Optional[TextIO]] = contextvars.ContextVar("account_output", default=None)
+
+
+class AccountOutput(io.TextIOBase):
+    """
+    Stands in for sys.stdout or sys.stderr, sending whatever is written to
+    the current account's own buffer, or to the real stream otherwise.
+    """
+
+    def __init__(self, stream: TextIO):
+        self.stream = stream
+
+    def target(self) -> TextIO:
+        return account_output.get() or self.stream
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, text: str) -> int:
+        return self.target().write(text)
+
+    def flush(self):
+        self.target().flush()
+
+
+class Account(NamedTuple):
+    """
+    One job for run_accounts(): a name to report it under, the servers it
+    connects to, and a function to do the work. logins are the imapdedup
+    arguments it logs in with, so any passwords can be asked for before
+    jobs start running side by side.
+    """
+    name: str
+    servers: List[str]
+    run: Callable[[], Any]
+    logins: Iterable[List[str]] = ()
+
+
+class AccountResult(NamedTuple):
+    name: str
+    seconds: float
+    error: Optional[str]
+    summary: Any
+
+
+def account_server(args: List[str]) -> str:
+    """
+    Return the server that a list of imapdedup arguments connects to.
+    """
+    for i, arg in enumerate(args):
+        if arg in ("-s", "--server", "-P", "--process") and i + 1 < len(args):
+            return args[i + 1]
+        if arg.startswith(("--server=", "--process=")):
+            return arg.split("=", 1)[1]
+    return ""
+
+
+def run_accounts(accounts: List[Account], jobs: int = 1, per_server: int = 1) -> List[AccountResult]:
+    """
+    Run each account's job, up to `jobs` at once, but no more than
+    `per_server` at once on any one server. With more than one job, each
+    account's output is collected separately and printed in one piece when
+    it finishes. A job that fails, or exits, doesn't stop the others.
+    Returns the results in the original order.
+    """
+    def run(account: Account, output: Optional[TextIO]) -> AccountResult:
+        if output is not None:
+            account_output.set(output)
+        started = time.perf_counter()
+        error = summary = None
+        try:
+            summary = account.run()
+        except SystemExit as e:
+            error = f"exited with status {e.code}"
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        return AccountResult(account.name, time.perf_counter() - started, error, summary)
+
+    if jobs <= 1:
+        results = []
+        for account in accounts:
+            print(account.name)
+            results.append(run(account, None))
+        return results
+
+    # Ask for any passwords now, one at a time, while we have the terminal
+    for account in accounts:
+        for args in account.logins:
+            try:
+                get_arguments(list(args))
+            except SystemExit:
+                pass  # the job will report what's wrong
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = AccountOutput(stdout), AccountOutput(stderr)
+    busy: Dict[str, int] = {}
+    waiting = list(enumerate(accounts))
+    running: Dict[Future, Tuple[int, io.StringIO]] = {}
+    results: List[Optional[AccountResult]] = [None] * len(accounts)
+    try:
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            while waiting or running:
+                # Start whatever we can without going over any server's limit
+                for index, account in list(waiting):
+                    if len(running) >= jobs:
+                        break
+                    if all(busy.get(server, 0) < per_server for server in set(account.servers)):
+                        waiting.remove((index, account))
+                        for server in set(account.servers):
+                            busy[server] = busy.get(server, 0) + 1
+                        output = io.StringIO()
+                        future = pool.submit(contextvars.copy_context().run, run, account, output)
+                        running[future] = (index, output)
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    index, output = running.pop(future)
+                    account = accounts[index]
+                    for server in set(account.servers):
+                        busy[server] -= 1
+                    result = results[index] = future.result()
+                    stdout.write(f"===== {account.name} =====\n{output.getvalue()}")
+                    if result.error:
+                        stderr.write(f"{account.name} failed: {result.error}\n")
+                    stdout.flush()
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+    return [result for result in results if result is not None]
+
+
+def print_account_summary(results: List[AccountResult]):
+    """
+    Print a line for each account saying how it went, with the message and
+    duplicate counts from its last imapdedup run, where there was one.
+    """
+    print()
+    print(f"{'account':<30} {'status':<8} {'seconds':>8} {'messages':>9} {'duplicates':>10}")
+    for result in results:
+        summary = result.summary if isinstance(result.summary, dict) else {}
+        print(
+            f"{result.name:<30} {'failed' if result.error else 'ok':<8} {result.seconds:>8.1f} "
+            f"{summary.get('messages', ''):>9} {summary.get('duplicates', ''):>10}"
+        )
+    failed = [result for result in results if result.error]
+    for result in failed:
+        print(f"{result.name}: {result.error}")
+    print(f"{len(results) - len(failed)} of {len(results)} account(s) completed")
+
+
+def process(
+    options, mboxes: List[str], server: Optional[imaplib.IMAP4] = None, metrics: Optional[Metrics] = None,
+) -> Optional[Dict[str, int]]:
+    """
+    Run imapdedup with the given options, under cProfile if --profile
+    was given, and write out the --metrics report if asked for one.
+    Returns the number of mailboxes and messages looked at and duplicates
+    found, if it got as far as looking for them.
+
+    If a server connection is given, it's used and left open, rather than
+    making a new one (see Deduper), in which case the metrics it counts
+    its traffic in should be given too.
+    """
+    metrics = metrics or Metrics(enabled=bool(options.metrics))
+    if options.profile:
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(process_with_retries, options, mboxes, metrics, server)
+        finally:
+            profiler.dump_stats(options.profile)
+            print(f"Profile saved to {options.profile}")
+    else:
+        return process_with_retries(options, mboxes, metrics, server)
+
+
+def process_with_retries(
+    options, mboxes: List[str], metrics: Metrics, server: Optional[imaplib.IMAP4] = None
+) -> Optional[Dict[str, int]]:
+    """
+    With --checkpoint, if the connection drops, reconnect and carry on from
+    the checkpoint, up to --retries times. Failing to reconnect counts as
+    another try, since the server may still be on its way back up, but if
+    we can't connect in the first place, there's no point trying again.
+    """
+    resume = options.resume
+    attempt = 0
+    try:
+        while True:
+            try:
+                return process_mailboxes(options, list(mboxes), metrics, resume, server)
+            except ConnectionFailed as e:
+                if attempt == 0 or attempt >= options.retries:
+                    sys.exit(1)
+                attempt += 1
+                delay = 2 ** attempt
+                print(f"Couldn't reconnect to the server ({e}); trying again in {delay} seconds...")
+                time.sleep(delay)
+            except CONNECTION_ERRORS as e:
+                if not options.checkpoint or attempt >= options.retries:
+                    raise
+                attempt += 1
+                delay = 2 ** attempt
+                print(f"Lost connection to the server ({e}); resuming from {options.checkpoint} in {delay} seconds...")
+                time.sleep(delay)
+                resume = True
+                server = None  # a connection we were given is no use now
+    finally:
+        # Once for the whole run, however many tries it took
+        if options.metrics:
+            metrics.write(options.metrics, options, sum(metrics.scanned.values()))
+
+
+# This actually does the work
+def process_mailboxes(
+    options, mboxes: List[str], metrics: Metrics, resume: bool = False, server: Optional[imaplib.IMAP4] = None,
+) -> Optional[Dict[str, int]]:
+    # A connection we were given belongs to the caller, who logs out
+    own_server = server is None
+    if own_server and getattr(options, "uses_server", True):
+        with metrics.phase("connect"):
+            server = connect(options, metrics)
 
     # List mailboxes option
     # Just do that and then exit
@@ -572,133 +3050,142 @@ def process(options, mboxes: List[str]):
             json.dump(mailbox_list, f, indent=2, separators=(',', ': '), sort_keys=True)
         return
 
-    delete_set = set()
+    delete_set: Any = MessageIndex()
     if options.delete_ids:
-        with open(options.delete_ids) as f:
-            for line in f:
-                delete_set.add(line.strip())
+        delete_set = load_ids(options.delete_ids)
 
-    if len(mboxes) == 0:
+    local_sources = list(options.local_sources)
+    if len(mboxes) == 0 and not local_sources:
         sys.stderr.write("\nError: Must specify mailbox\n")
         sys.exit(1)
 
     # Recursive option
     # Add child mailboxes to mboxes
-    if options.recursive:
+    if options.recursive and mboxes:
         # Make sure mailbox name is surrounded by quotes if it contains a space
         parent = add_quotes(mboxes[0])
-        # Fetch the hierarchy delimiter
-        bits = parse_list_response(check_response(server.list(parent, '""'))[0])
-        delimiter = bits[1].decode()
-        pattern='"' + delimiter + '*"'
-        for mb in get_mailbox_list(server, parent, pattern):
-            mboxes.append(mb)
+        with metrics.phase("list"):
+            # Fetch the hierarchy delimiter
+            bits = parse_list_response(check_response(server.list(parent, '""'))[0])
+            delimiter = bits[1].decode()
+            pattern='"' + delimiter + '*"'
+            for mb in get_mailbox_list(server, parent, pattern):
+                mboxes.append(mb)
         print("Working recursively from mailbox %s. There are %d total mailboxes." % (parent, len(mboxes)))
 
     if options.reverse:
         mboxes.reverse()
+        local_sources.reverse()
+
+    cache: Optional[Dict[str, Any]] = None
+    if options.cache:
+        cache = load_cache(options.cache)
+    header_fields = get_header_fields(options)
+    wanted = [field.lower() for field in header_fields]
 
-    if len(mboxes) > 1:
-        print("Working with mailboxes in order: %s" % (", ".join(mboxes)))
+    # Local sources come after the IMAP mailboxes, or before them in reverse
+    if len(mboxes) + len(local_sources) > 1:
+        ordered = local_sources + mboxes if options.reverse else mboxes + local_sources
+        print("Working with mailboxes in order: %s" % (", ".join(ordered)))
 
     # OK - let's get started.
     # Iterate through a set of named mailboxes and delete the later messages discovered.
+    cache_changed = False
+    checkpoint: Optional[Checkpoint] = None
+    msg_list: Optional[MessageListWriter] = None
     try:
         parser = BytesParser()  # can be the same for all mailboxes
         # Create a list of previously seen message IDs, in any mailbox
-        msg_ids: Dict[str, str] = {}
-        msg_list = [ ]
-        for mbox in mboxes:
+        msg_ids = MessageIndex()
+        msg_list = MessageListWriter(options.save_msg_list) if options.save_msg_list else None
+        # IDs are written out as they're first seen, since the index doesn't keep them
+        ids_file = open_saved_ids(options.save_ids) if options.save_ids else None
+        checkpoint = Checkpoint(options.checkpoint, resume) if options.checkpoint else None
+
+        # Make sure mailbox names are surrounded by quotes if they contain a space
+        mboxes = [add_quotes(mbox) for mbox in mboxes]
+        names = local_sources + mboxes if options.reverse else mboxes + local_sources
+
+        # Scanning can happen in parallel on other connections, but we always
+        # go through the results in mailbox order, so the first copy found
+        # is still the one that's kept.
+        size_matches: Optional[Dict[str, Dict[int, str]]] = None
+        if options.same_size or options.same_date:
+            size_matches = find_size_matches(server, options, mboxes, metrics)
+
+        scans: Iterable[MailboxScan]
+        if options.jobs > 1:
+            scans = scan_mailboxes_in_parallel(options, mboxes, cache, metrics, checkpoint, size_matches, msg_list)
+        else:
+            scans = (
+                scan_mailbox(
+                    server, options, mbox, cache, readonly=options.dry_run, metrics=metrics, checkpoint=checkpoint,
+                    size_keys=size_matches[mbox] if size_matches is not None else None, msg_list=msg_list,
+                )
+                for mbox in mboxes
+            )
+        if local_sources:
+            local_scans = (scan_local_source(options, path, metrics, msg_list) for path in local_sources)
+            scans = chain(local_scans, scans) if options.reverse else chain(scans, local_scans)
+        # The mailbox currently selected on our own connection, if any
+        selected: Optional[str] = None
+
+        for mbox_index, scan in enumerate(scans):
+            mbox = scan.mbox
+            if options.jobs == 1 and scan.local is None:
+                selected = mbox
             msgs_to_delete = []  # should be reset for each mbox
             msg_map = {}  # should be reset for each mbox
+            metrics.scanned[mbox] = len(scan.messages)
+            index_phase = metrics.phase("index", mbox, len(scan.messages))
+            index_phase.__enter__()
 
-            # Make sure mailbox name is surrounded by quotes if it contains a space
-            mbox = add_quotes(mbox)
-
-            # Select the mailbox
-            msgs = check_response(server.select(mailbox=mbox, readonly=options.dry_run))[0]
-            print("There are %d messages in %s." % (int(msgs), mbox))
-
-            # Check how many messages are already marked 'deleted'...
-            numdeleted = len(get_deleted_msgnums(server, options.sent_before))
-            print(f'{numdeleted or "No"} message(s) currently marked as deleted in {mbox}')
-
-            # Now get a list of the ones that aren't deleted.
-            # That's what we'll actually use.
-            msgnums = get_undeleted_msgnums(server, options.sent_before)
-            print(f"{len(msgnums)} others in {mbox}")
-
-            chunkSize = 100
-            if options.verbose:
-                print("Reading the others... (in batches of %d)" % chunkSize)
-
-            for i in range(0, len(msgnums), chunkSize):
+            for mnum, msg_id, info in scan.messages:
                 if options.verbose:
-                    print("Batch starting at item %d" % i)
-
-                # and parse them.
-                for mnum, hinfo in get_msg_headers(server, msgnums[i: i + chunkSize]):
-                    # Parse the header info into a Message object
-                    mp = parser.parsebytes(hinfo)
-
-                    if options.save_msg_list:
-                        from_header = str_header(mp, "From")
-                        if '@' not in from_header:
-                            print()
-                            print('no email found in "from"')
-                            print(mp)
-                            # exit(1)
-                        if '<' in from_header and '>' in from_header:
-                            from_email = from_header[from_header.index('<') + 1:from_header.index('>')]
-                        else:
-                            from_email = from_header
-
-                        # weird order due to the specific use case
-                        msg_list.append('\t'.join([
-                            from_header,
-                            from_email,
-                            str_header(mp, "Subject"),
-                            str_header(mp, "Date")
-                        ]))
-
-                    if options.verbose:
-                        print(f"Checking {mbox} message {mnum}")
-                        # Store message only when verbose is enabled (to print it later on)
-                        msg_map[mnum] = mp
-
-                    # Record the message-ID header (or generate one from other headers)
-                    msg_id = get_message_id(
-                        mp, options.use_checksum, options.use_id_in_checksum
-                    )
-
-                    if msg_id:
-                        if options.delete_ids and msg_id in delete_set:
-                            # artificially add this entry using the same format as the others
-                            # (can't just mark the id for deletion because we need mbox and mnum)
-                            msg_ids[msg_id] = f"{mbox}_{mnum}"
-
-                        # If we've seen this message before, record it as one to be
-                        # deleted in this mailbox.
-                        if msg_id in msg_ids:
+                    print(f"Checking {mbox} message {mnum}")
+
+                if msg_id:
+                    if options.delete_ids and msg_id in delete_set:
+                        # artificially add this entry using the same format as the others
+                        # (can't just mark the id for deletion because we need mbox and mnum)
+                        if msg_ids.set(msg_id, mbox_index, mnum) and ids_file is not None:
+                            ids_file.add(msg_id)
+
+                    # If we've seen this message before, record it as one to be
+                    # deleted in this mailbox.
+                    first_seen = msg_ids.get(msg_id)
+                    if first_seen is not None:
+                        print(
+                            "Message %s_%s is a duplicate of %s_%s and %s be %s"
+                            % (
+                                mbox, mnum, names[first_seen[0]], first_seen[1],
+                                options.dry_run and "would" or "will",
+                                "tagged as '%s'" % options.tag_name if options.tag_name else "marked as deleted",
+                            )
+                        )
+                        if (options.show or options.verbose) and info is not None:
+                            shown = dict(zip(MESSAGE_INFO_FIELDS, info))
                             print(
-                                "Message %s_%s is a duplicate of %s and %s be %s"
-                                % (
-                                    mbox, mnum, msg_ids[msg_id],
-                                    options.dry_run and "would" or "will",
-                                    "tagged as '%s'" % options.tag_name if options.tag_name else "marked as deleted",
-                                )
+                                "Subject: %s\nFrom: %s\nDate: %s\n"
+                                % (shown["Subject"], shown["From"], shown["Date"])
                             )
-                            if options.show or options.verbose:
-                                print(
-                                    "Subject: %s\nFrom: %s\nDate: %s\n"
-                                    % (mp["Subject"], mp["From"], mp["Date"])
-                                )
-                            msgs_to_delete.append(mnum)
-                        # Otherwise just record the fact that we've seen it
-                        else:
-                            msg_ids[msg_id] = f"{mbox}_{mnum}"
-
-                print(f"{min(len(msgnums), i + chunkSize)} message(s) in {mbox} processed")
+                        msgs_to_delete.append(mnum)
+                        # Keep what verbose mode lists at the end
+                        if options.verbose and info is not None:
+                            msg_map[mnum] = info
+                    # Otherwise just record the fact that we've seen it
+                    else:
+                        msg_ids.set(msg_id, mbox_index, mnum)
+                        if ids_file is not None:
+                            ids_file.add(msg_id)
+
+            index_phase.__exit__(None, None, None)
+            metrics.duplicates[mbox] = len(msgs_to_delete)
+
+            # The cache is written out once at the end, and only if something changed
+            if cache is not None and scan.cache_entry is not None and cache.get(mbox) != scan.cache_entry:
+                cache[mbox] = scan.cache_entry
+                cache_changed = True
 
             # OK - we've been through this mailbox, and msgs_to_delete holds
             # a list of the duplicates we've found.
@@ -713,11 +3200,29 @@ def process(options, mboxes: List[str]):
             elif not msgs_to_delete:
                 print(f"No duplicates were found in {mbox}")
 
+            elif scan.local is not None:
+                act_on_local_duplicates(options, scan, msgs_to_delete, msg_map)
+
             else:
+                # When the scan happened on another connection, we need to
+                # select the mailbox on this one before acting on it.
+                missing = [mnum for mnum in msgs_to_delete if mnum not in msg_map]
+                if selected != mbox and ((options.verbose and missing) or not options.dry_run):
+                    with metrics.phase("select", mbox):
+                        check_response(server.select(mailbox=mbox, readonly=options.dry_run))
+                    selected = mbox
+
                 if options.verbose:
+                    # Duplicates whose IDs came from the cache haven't had their headers read yet
+                    if missing:
+                        with metrics.phase("fetch", mbox, len(missing)):
+                            headers = get_msg_headers(server, missing, header_fields)
+                        for mnum, hinfo in headers:
+                            msg_map[mnum] = get_message_info(parse_headers(hinfo, wanted, parser))
                     print("These are the duplicate messages: ")
                     for mnum in msgs_to_delete:
-                        print_message_info(msg_map[mnum])
+                        if mnum in msg_map:
+                            print_message_info(msg_map[mnum])
 
                 if options.dry_run:
                     print(
@@ -736,52 +3241,286 @@ def process(options, mboxes: List[str]):
                         print("Tagging %i messages as '%s'..." % (len(msgs_to_delete), options.tag_name))
                     else:
                         print("Marking %i messages as deleted..." % (len(msgs_to_delete)))
+                    # An interrupted run may have got through some of them already
+                    to_store = msgs_to_delete
+                    if checkpoint is not None:
+                        stored = checkpoint.get_stored(mbox, scan.uidvalidity)
+                        to_store = [mnum for mnum in msgs_to_delete if mnum not in stored]
+                        if len(to_store) < len(msgs_to_delete):
+                            print("(%d of them were done before the last run was interrupted)"
+                                  % (len(msgs_to_delete) - len(to_store)))
                     # Deleting messages one at a time can be slow if there are many,
                     # so we batch them up.
-                    chunkSize = 30
+                    # Neighbouring UIDs are merged into ranges, and each batch is as
+                    # big as the server's command line limit allows.
+                    batches = list(batch_uid_sets(to_store))
                     if options.verbose:
-                        print("(in batches of %d)" % chunkSize)
-                    for i in range(0, len(msgs_to_delete), chunkSize):
-                        process_messages(server, msgs_to_delete[i: i + chunkSize], options.tag_name, options.copy_mailbox)
+                        print("(in %d batch(es))" % len(batches))
+                    done = 0
+                    for uid_set, count in batches:
+                        with metrics.phase("store", mbox, count):
+                            process_messages(server, uid_set, options.tag_name, options.copy_mailbox)
+                        if checkpoint is not None:
+                            checkpoint.record_stored(mbox, scan.uidvalidity, uid_set)
+                        done += count
                         if options.verbose:
-                            print("Batch starting at item %d marked." % i)
-                    print("Confirming new numbers...")
-                    numdeleted = len(get_deleted_msgnums(server, options.sent_before))
-                    numundel = len(get_undeleted_msgnums(server, options.sent_before))
+                            print("%d message(s) marked." % done)
+                    # Every STORE succeeded, so we know the new numbers
+                    # without searching the mailbox again.
+                    numdeleted, numundel = scan.deleted, len(scan.messages)
+                    if not options.tag_name:
+                        numdeleted += len(msgs_to_delete)
+                        numundel -= len(msgs_to_delete)
                     print(
                         "There are now %s messages marked as deleted and %s others in %s."
                         % (numdeleted, numundel, mbox)
                     )
                     if options.tag_name:
-                        numtagged = len(get_tagged_msgnums(server, options.tag_name, options.sent_before))
+                        # Some may have had the tag already, so we have to ask
+                        print("Confirming new numbers...")
+                        with metrics.phase("confirm", mbox):
+                            numtagged = count_matching_msgs(server, f"KEYWORD {options.tag_name}", options.sent_before)
                         print(
                         "There are now %s messages tagged as '%s' in %s."
                         % (numtagged, options.tag_name, mbox)
                     )
 
-        if options.save_ids:
-            # for msg_id, mbox_path in msg_ids.items():
-            with open(options.save_ids, 'wt') as f:
-                # for msg_id in sorted(msg_ids.keys()):
-                for msg_id in msg_ids.keys():
-                    print(msg_id, file=f)
-
-        if options.save_msg_list:
-            with open(options.save_msg_list, 'wt') as f:
-                # for msg_id in sorted(msg_ids.keys()):
-                # for msg_id in msg_ids.keys():
-                #     print(msg_id, file=f)
-                print('from\temail\tsubject\tdate', file=f)
-                for line in msg_list:
-                    print(line, file=f)
-
-        if not options.no_close:
-            server.close()
+        if ids_file is not None:
+            ids_file.close()
+        if isinstance(delete_set, IdStore):
+            delete_set.close()
+        if checkpoint is not None:
+            # We got to the end, so there's nothing to resume
+            checkpoint.finish()
+            checkpoint = None
+
+        if msg_list is not None:
+            msg_list.close()
+            msg_list = None
+
+        if cache_changed:
+            with metrics.phase("cache"):
+                save_cache(options.cache, cache)
+            cache_changed = False
+
+        # With --jobs, we may never have needed to select anything on this connection
+        if not options.no_close and server is not None and server.state == "SELECTED":
+            with metrics.phase("close"):
+                server.close()
 
     except ImapDedupException as e:
         print("Error:", e, file=sys.stderr)
     finally:
-        server.logout()
+        if checkpoint is not None:
+            checkpoint.close()
+        if msg_list is not None:
+            msg_list.close()  # keep what we found before things went wrong
+        if cache_changed:
+            save_cache(options.cache, cache)  # likewise the mailboxes we got through
+        try:
+            if server is not None and own_server:
+                with metrics.phase("logout"):
+                    server.logout()
+        except (imaplib.IMAP4.error, OSError):
+            pass  # the connection may be what failed
+
+    # The metrics cover any earlier tries, so this is for the whole run
+    return {
+        "mailboxes": len(mboxes),
+        "messages": sum(metrics.scanned.values()),
+        "duplicates": sum(metrics.duplicates.values()),
+    }
+
+
+class Deduper:
+    """
+    A session with one account, for scripts that work in several steps.
+    The connection is made when first needed and kept open until close()
+    (or the end of a with block), so later steps don't have to connect
+    and log in again:
+
+        with Deduper(["-x", "-s", "imap.example.com", "-u", "me"]) as deduper:
+            scans = deduper.scan(["INBOX", "Archive"])
+            plan = deduper.plan(scans)
+            deduper.apply(plan)
+
+    args are command line options as for imapdedup.py itself (without
+    mailboxes), and apply to every step. scan(), plan() and apply() keep
+    their results in memory, while run() does a whole imapdedup run, with
+    any further options, on the same connection. scan() raises
+    ImapDedupException for options that only a whole run supports, such
+    as --checkpoint or --save-ids.
+
+    With --metrics, what scan(), plan() and apply() did is written out as a
+    run of its own when the session is closed, or before the next run().
+    """
+
+    # Options that scan() can't do, by their dest, with how they're given
+    RUN_ONLY_OPTIONS = {
+        "local_sources": "--local", "checkpoint": "--checkpoint", "save_ids": "--save-ids",
+        "save_msg_list": "--save-msg-list", "delete_ids": "--delete-ids", "recursive": "-r",
+        "profile": "--profile",
+    }
+
+    def __init__(self, args: List[str]):
+        self.options, _ = get_arguments(list(args))
+        self.args = list(args)
+        if self.options.password and not {"-w", "--password"} & set(self.args):
+            # Don't ask for it again in run()
+            self.args += ["-w", self.options.password]
+        self.server: Optional[imaplib.IMAP4] = None
+        self.metrics = Metrics(enabled=bool(self.options.metrics))
+
+    def __enter__(self) -> "Deduper":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def connect(self) -> imaplib.IMAP4:
+        """
+        Return the session's connection, making a new one if there isn't
+        one or the old one has been dropped.
+        """
+        if self.server is not None:
+            try:
+                check_response(self.server.noop())
+            except (imaplib.IMAP4.error, OSError):
+                self.server = None
+        if self.server is None:
+            try:
+                with self.metrics.phase("connect"):
+                    self.server = connect(self.options, self.metrics)
+            except ConnectionFailed:
+                sys.exit(1)
+        return self.server
+
+    def close(self):
+        """ Log out, if we're connected, and write out any metrics. """
+        if self.server is not None:
+            try:
+                if not self.options.no_close and self.server.state == "SELECTED":
+                    with self.metrics.phase("close"):
+                        self.server.close()
+                with self.metrics.phase("logout"):
+                    self.server.logout()
+            except (imaplib.IMAP4.error, OSError):
+                pass
+            self.server = None
+        self.write_metrics()
+
+    def write_metrics(self):
+        """ Write out what's been recorded since the last time, with --metrics. """
+        if self.options.metrics and self.metrics.records:
+            self.metrics.write(self.options.metrics, self.options, sum(self.metrics.scanned.values()))
+        self.metrics.reset()
+
+    def list_mailboxes(self) -> List[str]:
+        return get_mailbox_list(self.connect())
+
+    def scan(self, mboxes: List[str]) -> List[MailboxScan]:
+        """
+        Work out the ID of every undeleted message in the mailboxes, without
+        changing anything, as a run with these options would.
+        """
+        options = self.options
+        for dest, flag in self.RUN_ONLY_OPTIONS.items():
+            if getattr(options, dest):
+                raise ImapDedupException(f"{flag} needs a whole run, so use run() instead of scan()")
+        server = self.connect()
+        mboxes = [add_quotes(mbox) for mbox in mboxes]
+        if options.reverse:
+            mboxes.reverse()
+        cache = load_cache(options.cache) if options.cache else None
+
+        size_matches: Optional[Dict[str, Dict[int, str]]] = None
+        if options.same_size or options.same_date:
+            size_matches = find_size_matches(server, options, mboxes, self.metrics)
+        if options.jobs > 1:
+            scans = list(scan_mailboxes_in_parallel(options, mboxes, cache, self.metrics, None, size_matches))
+        else:
+            scans = [
+                scan_mailbox(
+                    server, options, mbox, cache, readonly=True, metrics=self.metrics,
+                    size_keys=size_matches[mbox] if size_matches is not None else None,
+                )
+                for mbox in mboxes
+            ]
+
+        changed = False
+        for scan in scans:
+            self.metrics.scanned[scan.mbox] = len(scan.messages)
+            if cache is not None and scan.cache_entry is not None and cache.get(scan.mbox) != scan.cache_entry:
+                cache[scan.mbox] = scan.cache_entry
+                changed = True
+        if changed:
+            with self.metrics.phase("cache"):
+                save_cache(options.cache, cache)
+        return scans
+
+    def plan(self, scans: List[MailboxScan], delete_ids: Optional[Any] = None) -> Dict[str, List[int]]:
+        """
+        Return the UIDs to mark in each mailbox: every copy of a message after
+        the first, going through the scans in order, plus any whose ID is in
+        delete_ids (a set, or anything from load_ids()).
+        """
+        msg_ids = MessageIndex()
+        plan: Dict[str, List[int]] = {}
+        for mbox_index, scan in enumerate(scans):
+            duplicates = plan.setdefault(scan.mbox, [])
+            for mnum, msg_id, _ in scan.messages:
+                if not msg_id:
+                    continue
+                if (delete_ids is not None and msg_id in delete_ids) or msg_ids.get(msg_id) is not None:
+                    duplicates.append(mnum)
+                else:
+                    msg_ids.set(msg_id, mbox_index, mnum)
+            self.metrics.duplicates[scan.mbox] = len(duplicates)
+        return plan
+
+    def apply(self, plan: Dict[str, List[int]]) -> int:
+        """
+        Mark the planned messages as deleted (or tag or copy them, as the
+        options say), unless it's a dry run. Returns how many there were.
+        """
+        options = self.options
+        total = sum(len(uids) for uids in plan.values())
+        action = "tagged as '%s'" % options.tag_name if options.tag_name else "marked as deleted"
+        if options.dry_run:
+            print(f"If you had NOT selected the 'dry-run' option,\n  {total} messages would now be {action}.")
+            return total
+        server = self.connect()
+        for mbox, uids in plan.items():
+            if not uids:
+                continue
+            if options.copy_mailbox:
+                print(f"Copying {len(uids)} messages in {mbox} to '{options.copy_mailbox}'...")
+            if options.tag_name:
+                print(f"Tagging {len(uids)} messages in {mbox} as '{options.tag_name}'...")
+            else:
+                print(f"Marking {len(uids)} messages in {mbox} as deleted...")
+            with self.metrics.phase("select", mbox):
+                check_response(server.select(mailbox=mbox))
+            for uid_set, count in batch_uid_sets(uids):
+                with self.metrics.phase("store", mbox, count):
+                    process_messages(server, uid_set, options.tag_name, options.copy_mailbox)
+        return total
+
+    def run(self, args: List[str] = ()) -> Optional[Dict[str, int]]:
+        """
+        Do a whole run, as process() would, with these options and
+        mailboxes added to the session's.
+        """
+        options, mboxes = get_arguments(self.args + list(args))
+        # Keep what the other steps did separate from this run
+        self.write_metrics()
+        server = self.connect()
+        try:
+            # The connection counts its traffic in the session's metrics
+            return process(options, mboxes, server, self.metrics if self.metrics.enabled else None)
+        finally:
+            self.metrics.reset()
+
 
 if __name__ == "__main__":
     options, mboxes = get_arguments()
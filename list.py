@@ -27,9 +27,11 @@ https://myaccount.google.com/u/2/apppasswords
 (the /u/2 depends on which Google account is in the browser...)
 '''
 
+import argparse
 import json
 import os
 import sys
+from functools import partial
 
 import imapdedup
 
@@ -46,10 +48,10 @@ def handle_account(key, source_options):
     if not os.path.exists(folder_list_path):
         print(f'Saving list of mailboxes to {folder_list_path}')
         print('Remove any entries from that file, and then run again to create a list of messages')
-        options = [
-            "--save-list", folder_list_path
-        ]
-        imapdedup.process(*imapdedup.get_arguments(source_options + options))
+        with imapdedup.Deduper(source_options) as source:
+            mailbox_list = source.list_mailboxes()
+        with open(folder_list_path, 'wt') as f:
+            json.dump(mailbox_list, f, indent=2, separators=(',', ': '), sort_keys=True)
 
     elif not os.path.exists(msg_list_path):
         # print(f'Writing a list of all message IDs from the source to {source_id_path}')
@@ -61,10 +63,11 @@ def handle_account(key, source_options):
         with open(folder_list_path, 'r') as f:
             mboxes = json.load(f)
 
-        imapdedup.process(*imapdedup.get_arguments(source_options + options + mboxes))
+        with imapdedup.Deduper(source_options) as source:
+            return source.run(options + mboxes)
 
 
-def handle(config_path):
+def handle(config_path, jobs=4, per_server=2):
     if not os.path.exists(config_path):
         print(f'{config_path} does not exist')
         sys.exit(1)
@@ -72,13 +75,24 @@ def handle(config_path):
     with open(config_path) as f:
         parsed = json.load(f)
 
-    for key, args in parsed.items():
-        print(key)
-        handle_account(key, args)
+    # Accounts on different servers can run side by side,
+    # while being gentle with any one server
+    accounts = [
+        imapdedup.Account(key, [imapdedup.account_server(args)], partial(handle_account, key, args), [args])
+        for key, args in parsed.items()
+    ]
+    results = imapdedup.run_accounts(accounts, jobs, per_server)
+    imapdedup.print_account_summary(results)
 
 
 if __name__ == "__main__":
-    if len(sys.argv) == 2:
-        handle(sys.argv[1])
-    else:
-        print(f'Usage: {sys.argv[0]} <config json name>')
+    parser = argparse.ArgumentParser(description='Save the mailboxes and messages of each account in a config file.')
+    parser.add_argument('config', help='JSON file of account names and their imapdedup login options')
+    parser.add_argument('-j', '--jobs', type=int, default=4,
+                        help='Number of accounts to work on at once (default 4)')
+    parser.add_argument('--per-server', type=int, default=2,
+                        help='Most accounts to work on at once on the same server (default 2)')
+    args = parser.parse_args()
+    if args.jobs < 1 or args.per_server < 1:
+        parser.error('--jobs and --per-server must be at least 1')
+    handle(args.config, args.jobs, args.per_server)